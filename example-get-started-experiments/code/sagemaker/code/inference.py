@@ -4,47 +4,169 @@ https://sagemaker.readthedocs.io/en/stable/frameworks/pytorch/using_pytorch.html
 """
 import io
 import os
+import tarfile
 
 import numpy as np
 import torch
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
 from torchvision.transforms import Compose, Normalize, Resize, ToTensor
 
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Images of a multi-image request run through the model this many at a time
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+# Input size of the model, the TorchScript export has its own
+IMG_SIZE = 512
+
+
+def get_transform(img_size):
+    return Compose(
+        [
+            Resize(img_size),
+            ToTensor(),
+            Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        ]
+    )
+
+
+IMG_TRANSFORM = get_transform(IMG_SIZE)
+
 
 def model_fn(model_dir, context):
-    kwargs = {
-        "f": os.path.join(model_dir, "code/model.pth")
-    }
-    if not torch.cuda.is_available():
-        kwargs["map_location"] = torch.device("cpu")
-    model = torch.load(**kwargs)
+    global IMG_TRANSFORM
+    img_size = IMG_SIZE
+    # On CPU hosts use the optimized TorchScript export if it was packaged
+    cpu_model_path = os.path.join(model_dir, "code/model_cpu.pt")
+    if not torch.cuda.is_available() and os.path.exists(cpu_model_path):
+        # The traced module is only valid for inputs of the size it was
+        # exported with, see `src/export.py`
+        extra_files = {"img_size": ""}
+        model = torch.jit.load(
+            cpu_model_path, map_location=torch.device("cpu"), _extra_files=extra_files
+        )
+        model = torch.jit.optimize_for_inference(model)
+        img_size = int(extra_files["img_size"] or IMG_SIZE)
+    else:
+        kwargs = {
+            "f": os.path.join(model_dir, "code/model.pth")
+        }
+        if not torch.cuda.is_available():
+            kwargs["map_location"] = torch.device("cpu")
+        model = torch.load(**kwargs)
+    model = model.to(DEVICE).eval()
+    IMG_TRANSFORM = get_transform(img_size)
+    # Warm-up, the lazy initialization is not paid by the first request
+    with torch.no_grad():
+        for _ in range(2):
+            model(torch.zeros(1, 3, img_size, img_size, device=DEVICE))
     return model
 
 
+def read_images(request_body, request_content_type):
+    # Named images of a multi-image request, the files of a tar archive or the
+    # HxWx3 uint8 arrays of an npz file
+    if request_content_type == "application/x-tar":
+        with tarfile.open(fileobj=io.BytesIO(request_body)) as tar:
+            return {
+                member.name: Image.open(io.BytesIO(tar.extractfile(member).read()))
+                for member in tar.getmembers()
+                if member.isfile()
+            }
+    with np.load(io.BytesIO(request_body)) as arrays:
+        return {name: Image.fromarray(arrays[name]) for name in arrays.files}
+
+
 def input_fn(request_body, request_content_type, context):
-    if request_content_type:
+    if request_content_type in ("application/x-tar", "application/x-npz"):
+        images = read_images(request_body, request_content_type)
+        return {name: IMG_TRANSFORM(img.convert("RGB")) for name, img in images.items()}
+    elif request_content_type:
         img_pil = Image.open(io.BytesIO(request_body))
-        img_transform = Compose([Resize(512), ToTensor(), Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
-        img_tensor = img_transform(img_pil).unsqueeze_(0)
+        img_tensor = IMG_TRANSFORM(img_pil).unsqueeze_(0)
         return img_tensor
     else:
         raise ValueError(f"Unsupported request_content_type {request_content_type}")
 
 
+def predict_batches(img_tensors, model):
+    # Images of the same size are stacked into batches of at most
+    # `MAX_BATCH_SIZE`, one forward pass each
+    by_shape = {}
+    for i, img_tensor in enumerate(img_tensors):
+        by_shape.setdefault(img_tensor.shape, []).append(i)
+    results = [None] * len(img_tensors)
+    for indices in by_shape.values():
+        for start in range(0, len(indices), MAX_BATCH_SIZE):
+            stop = start + MAX_BATCH_SIZE
+            batch_indices = indices[start:stop]
+            batch = torch.stack([img_tensors[i] for i in batch_indices]).to(DEVICE)
+            for i, result in zip(batch_indices, model(batch).cpu()):
+                results[i] = result
+    return results
+
+
 def predict_fn(input_object, model, context):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
     with torch.no_grad():
-        result = model(input_object)
+        if isinstance(input_object, dict):
+            results = predict_batches(list(input_object.values()), model)
+            return dict(zip(input_object, results))
+        result = model(input_object.to(DEVICE))
     return result
 
 
-def output_fn(prediction_output, content_type):
-    output = np.array(
-        prediction_output[:, 1, :] > 0.5, dtype=np.uint8
-    )
-    if torch.cuda.is_available():
-        output = output.cpu()
+# Compact alternatives to `np.save` for the masks, by `Accept` header
+MASK_ENCODINGS = ("application/x-packbits", "application/x-rle", "image/png")
+
+
+def encode_shape(mask):
+    return np.array([mask.ndim, *mask.shape], dtype="<u4").tobytes()
+
+
+def encode_mask(mask, accept):
+    # Binary masks in a compact encoding chosen by the `Accept` header, the
+    # shape comes first so that clients restore the same array as `np.save`
+    if accept == "application/x-packbits":
+        return encode_shape(mask) + np.packbits(mask.ravel()).tobytes()
+    if accept == "application/x-rle":
+        # Lengths of the alternating runs of 0 and 1, starting with 0
+        flat = mask.ravel()
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = np.concatenate([[0], changes, [flat.size]])
+        runs = np.diff(bounds)
+        if flat.size and flat[0]:
+            runs = np.concatenate([[0], runs])
+        return encode_shape(mask) + runs.astype("<u4").tobytes()
+    if accept == "image/png":
+        info = PngInfo()
+        info.add_text("shape", ",".join(map(str, mask.shape)))
+        # PNG can not hold an empty image, an empty mask is sent as a single
+        # pixel that the client drops
+        pixels = mask.reshape(-1, mask.shape[-1]) if mask.size else np.zeros((1, 1), np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG", pnginfo=info)
+        return buffer.getvalue()
     buffer = io.BytesIO()
-    np.save(buffer, output)
+    np.save(buffer, mask)
     return buffer.getvalue()
+
+
+def output_fn(prediction_output, content_type):
+    # `content_type` is the `Accept` header of the request
+    if isinstance(prediction_output, dict):
+        # One mask per image of a multi-image request, by name, as the bytes of
+        # the requested encoding if it is a compact one
+        masks = {
+            name: np.array(prediction[1] > 0.5, dtype=np.uint8)
+            for name, prediction in prediction_output.items()
+        }
+        if content_type in MASK_ENCODINGS:
+            masks = {
+                name: np.frombuffer(encode_mask(mask, content_type), dtype=np.uint8)
+                for name, mask in masks.items()
+            }
+        buffer = io.BytesIO()
+        np.savez(buffer, **masks)
+        return buffer.getvalue()
+    # The prediction is still on the device
+    output = (prediction_output[:, 1, :] > 0.5).cpu().numpy().astype(np.uint8)
+    return encode_mask(output, content_type)
@@ -50,6 +50,7 @@ def deploy(
             "TS_MAX_REQUEST_SIZE": "2000000000",
             "MMS_MAX_RESPONSE_SIZE": "2000000000",
             "MMS_MAX_REQUEST_SIZE": "2000000000",
+            "MAX_BATCH_SIZE": "8",
         },
     )
 
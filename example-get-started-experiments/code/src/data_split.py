@@ -1,4 +1,9 @@
+import csv
+import os
+import re
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -9,6 +14,51 @@ from ruamel.yaml import YAML
 
 yaml = YAML(typ="safe")
 
+# Index of the split, one row per image, read by the downstream stages instead
+# of scanning the split directories
+INDEX_FPATH = Path("data") / "split.csv"
+INDEX_COLUMNS = ["name", "split", "image", "mask", "source"]
+
+
+def get_source(img_path, msk_path):
+    # Size and modification time of the source files, to detect changed files
+    # without reading them
+    img_stat, msk_stat = img_path.stat(), msk_path.stat()
+    return f"{img_stat.st_size}:{img_stat.st_mtime_ns}:{msk_stat.st_size}:{msk_stat.st_mtime_ns}"
+
+
+def place_file(src, dst, link_mode="copy"):
+    if dst.exists():
+        dst.unlink()
+    if link_mode == "link":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # E.g. another file system, fall back to a copy
+            pass
+    shutil.copy(src, dst)
+
+
+def remove_files(row):
+    for fpath in (row["image"], row["mask"]):
+        Path(fpath).unlink(missing_ok=True)
+
+
+def read_index(index_fpath=INDEX_FPATH):
+    if not index_fpath.exists():
+        return {}
+    with open(index_fpath, newline="", encoding="utf-8") as fd:
+        return {row["name"]: row for row in csv.DictReader(fd)}
+
+
+def get_split_files(split, index_fpath=INDEX_FPATH):
+    # Image files of a split, from the index if there is one
+    if not index_fpath.exists():
+        return get_files(Path("data") / f"{split}_data", extensions=".jpg")
+    rows = read_index(index_fpath).values()
+    return sorted(Path(row["image"]) for row in rows if row["split"] == split)
+
 
 def data_split():
     params = ConfigBox(yaml.load(open("params.yaml", encoding="utf-8")))
@@ -19,14 +69,57 @@ def data_split():
     train_data_dir.mkdir(exist_ok=True)
     test_data_dir = Path("data") / "test_data"
     test_data_dir.mkdir(exist_ok=True)
+    split_dirs = {"train": train_data_dir, "test": test_data_dir}
+    # A single scan of every path for all test regions
+    test_regions = re.compile(
+        "|".join(re.escape(region) for region in params.data_split.test_regions) or "(?!)"
+    )
+
+    # In the `link` mode the split directories share the files of the data set
+    # instead of copying them. Files are only placed again if their split or
+    # their source changed since the last run, that needs the outputs to be
+    # persisted between runs (`persist: true` in dvc.yaml, as generate.sh
+    # declares it).
+    previous = read_index()
+    if not previous:
+        sys.stderr.write("No index of a previous split, placing all files\n")
+    index = []
+    ops = []
     for img_path in img_fpaths:
         msk_path = Path("data") / "pool_data" / "masks" / f"{img_path.stem}.png"
-        if any(region in str(img_path) for region in params.data_split.test_regions):
-            shutil.copy(img_path, test_data_dir)
-            shutil.copy(msk_path, test_data_dir)
-        else:
-            shutil.copy(img_path, train_data_dir)
-            shutil.copy(msk_path, train_data_dir)
+        split = "test" if test_regions.search(str(img_path)) else "train"
+        row = {
+            "name": img_path.name,
+            "split": split,
+            "image": str(split_dirs[split] / img_path.name),
+            "mask": str(split_dirs[split] / msk_path.name),
+            "source": get_source(img_path, msk_path),
+        }
+        index.append(row)
+
+        old_row = previous.pop(row["name"], None)
+        if old_row == row and Path(row["image"]).exists() and Path(row["mask"]).exists():
+            continue
+        if old_row is not None and old_row["split"] != split:
+            remove_files(old_row)
+        ops.append((img_path, Path(row["image"])))
+        ops.append((msk_path, Path(row["mask"])))
+
+    # Images removed from the data set since the last run
+    for old_row in previous.values():
+        remove_files(old_row)
+
+    link_mode = params.data_split.link_mode
+    if link_mode not in ("copy", "link"):
+        raise ValueError(f"Unsupported link mode: {link_mode}")
+    with ThreadPoolExecutor(params.data_split.num_workers) as pool:
+        # Consume the results, to raise the errors of the file operations
+        list(pool.map(lambda op: place_file(*op, link_mode), ops))
+
+    with open(INDEX_FPATH, "w", newline="", encoding="utf-8") as fd:
+        writer = csv.DictWriter(fd, fieldnames=INDEX_COLUMNS)
+        writer.writeheader()
+        writer.writerows(index)
 
 
 if __name__ == "__main__":
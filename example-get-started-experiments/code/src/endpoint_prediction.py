@@ -4,11 +4,66 @@ from pathlib import Path
 import dvc.api
 import numpy as np
 from PIL import Image
-from sagemaker.deserializers import NumpyDeserializer
+from sagemaker.deserializers import NumpyDeserializer, SimpleBaseDeserializer
 from sagemaker.pytorch import PyTorchPredictor
 from sagemaker.serializers import IdentitySerializer
 
 
+# Response encodings of the masks, by `Accept` header, see `encode_mask` in
+# `sagemaker/code/inference.py`
+MASK_ACCEPT = {
+    "npy": "application/x-npy",
+    "packbits": "application/x-packbits",
+    "rle": "application/x-rle",
+    "png": "image/png",
+}
+# Multi-image responses are npz files, zip archives of the masks by name
+NPZ_MAGIC = b"PK\x03\x04"
+
+
+def decode_shape(body):
+    ndim = int.from_bytes(body[:4], "little")
+    shape = tuple(int(n) for n in np.frombuffer(body, "<u4", count=ndim, offset=4))
+    offset = 4 * (ndim + 1)
+    return shape, body[offset:]
+
+
+def decode_mask(body, accept):
+    if body.startswith(NPZ_MAGIC):
+        # The mask of every image by name, each one in the requested encoding
+        with np.load(BytesIO(body)) as arrays:
+            return {name: decode_mask(arrays[name].tobytes(), accept) for name in arrays.files}
+    if accept == "application/x-packbits":
+        shape, data = decode_shape(body)
+        bits = np.unpackbits(np.frombuffer(data, np.uint8), count=int(np.prod(shape)))
+        return bits.reshape(shape)
+    if accept == "application/x-rle":
+        shape, data = decode_shape(body)
+        runs = np.frombuffer(data, "<u4")
+        values = (np.arange(len(runs)) % 2).astype(np.uint8)
+        return np.repeat(values, runs).reshape(shape)
+    if accept == "image/png":
+        img = Image.open(BytesIO(body))
+        shape = tuple(int(n) for n in img.text["shape"].split(","))
+        pixels = np.asarray(img, dtype=np.uint8).ravel()
+        return pixels[: int(np.prod(shape))].reshape(shape)
+    return np.load(BytesIO(body))
+
+
+class MaskDeserializer(SimpleBaseDeserializer):
+    # Decodes the compact mask responses to the same arrays as
+    # `NumpyDeserializer` does for `application/x-npy`, and the responses of
+    # multi-image requests to a dict of those arrays by image name
+    def __init__(self, accept="application/x-packbits"):
+        super().__init__(accept=accept)
+
+    def deserialize(self, stream, content_type):
+        try:
+            return decode_mask(stream.read(), self.accept)
+        finally:
+            stream.close()
+
+
 def paint_mask(mask, color_map={0: (0, 0, 0), 1: (0, 0, 255)}):
     vis_shape = mask.shape + (3,)
     vis = np.zeros(vis_shape)
@@ -21,10 +76,17 @@ def endpoint_prediction(
     img_path: str,
     endpoint_name: str,
     output_path: str = "predictions",
+    encoding: str = "npy",
 ):
     params = dvc.api.params_show()
     img_size = params["train"]["img_size"]
-    predictor = PyTorchPredictor(endpoint_name, serializer=IdentitySerializer(), deserializer=NumpyDeserializer())
+    if encoding == "npy":
+        deserializer = NumpyDeserializer()
+    else:
+        deserializer = MaskDeserializer(MASK_ACCEPT[encoding])
+    predictor = PyTorchPredictor(
+        endpoint_name, serializer=IdentitySerializer(), deserializer=deserializer
+    )
     name = endpoint_name
     
     output_file = Path(output_path) / name / Path(img_path).name
@@ -50,7 +112,14 @@ if __name__ == "__main__":
     parser.add_argument('--img_path', type=str, help='path to the input image')
     parser.add_argument('--endpoint_name', type=str, help='name of the SageMaker endpoint to use')
     parser.add_argument('--output_path', type=str, default='predictions', help='path to save the output predictions')
+    parser.add_argument(
+        '--encoding',
+        type=str,
+        default='npy',
+        choices=list(MASK_ACCEPT),
+        help='encoding of the predicted mask in the response',
+    )
 
     args = parser.parse_args()
 
-    endpoint_prediction(args.img_path, args.endpoint_name, args.output_path)
+    endpoint_prediction(args.img_path, args.endpoint_name, args.output_path, args.encoding)
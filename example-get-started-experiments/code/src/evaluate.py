@@ -1,100 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 from box import ConfigBox
 from dvclive import Live
-from fastai.vision.all import get_files, load_learner
+from fastai.vision.all import AddMaskCodes, load_learner
 from PIL import Image
 from ruamel.yaml import YAML
 
+from data_split import get_split_files
 
-yaml = YAML(typ="safe")
 
+yaml = YAML(typ="safe")
 
-def dice(mask_pred, mask_true, classes=[0, 1], eps=1e-6):
-    dice_list = []
-    for c in classes:
-        y_true = mask_true == c
-        y_pred = mask_pred == c
-        intersection = 2.0 * np.sum(y_true * y_pred)
-        dice = intersection / (np.sum(y_true) + np.sum(y_pred) + eps)
-        dice_list.append(dice)
-    return np.mean(dice_list)
 
+def dice_stats(mask_true, mask_pred, n_classes=2):
+    # A single pass over the pixels: the joint histogram of the true and the
+    # predicted uint8 values, `true * 256 + pred`
+    codes = mask_true.astype(np.uint16).ravel() * 256 + mask_pred.ravel()
+    joint = np.bincount(codes, minlength=256 * 256).reshape(256, 256)
+    intersection = np.diag(joint)[:n_classes]
+    cardinality = joint.sum(axis=1)[:n_classes] + joint.sum(axis=0)[:n_classes]
+    return intersection, cardinality
 
-def paint_mask(mask, color_map={0: (0, 0, 0), 1: (0, 0, 255)}):
-    vis_shape = mask.shape + (3,)
-    vis = np.zeros(vis_shape)
-    for i, c in color_map.items():
-        vis[mask == i] = color_map[i]
-    return Image.fromarray(vis.astype(np.uint8))
 
+def dice_per_class(intersection, cardinality, eps=1e-6):
+    # 2 * |true & pred| / (|true| + |pred|) of every class
+    return 2.0 * intersection / (cardinality + eps)
 
-def stack_images(im1, im2):
-    dst = Image.new("RGB", (im1.width + im2.width, im1.height))
-    dst.paste(im1, (0, 0))
-    dst.paste(im2, (im1.width, 0))
-    return dst
 
+def make_palette(color_map):
+    # Lookup table from mask values to colors, `palette[mask]` paints a mask
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for i, c in color_map.items():
+        palette[i] = c
+    return palette
 
-def get_overlay_image(img_fpath, mask_true, mask_pred):
-    img_pil = Image.open(img_fpath)
-    overlay_img_true = Image.blend(
-        img_pil.convert("RGBA"), paint_mask(mask_true).convert("RGBA"), 0.5
-    )
 
-    new_color_map = {
+PALETTE_TRUE = make_palette({0: (0, 0, 0), 1: (0, 0, 255)})
+PALETTE_PRED = make_palette(
+    {
         0: (0, 0, 0),  # no color - TN
         1: (255, 0, 255),  # purple - FN
         2: (255, 255, 0),  # yellow - FP
         3: (0, 0, 255),  # blue - TP
     }
+)
+
+
+def get_overlay_image(img_fpath, mask_true, mask_pred, size=(512, 256)):
+    # Everything is rendered at the output resolution, the image and the masks
+    # are resized first, each one takes half of the width
+    half_size = (size[0] // 2, size[1])
+    img = np.asarray(Image.open(img_fpath).convert("RGB").resize(half_size), dtype=np.uint16)
+    mask_true = np.asarray(Image.fromarray(mask_true).resize(half_size, Image.NEAREST))
+    mask_pred = np.asarray(Image.fromarray(mask_pred).resize(half_size, Image.NEAREST))
     combined_mask = mask_true + 2 * mask_pred
 
-    overlay_img_pred = Image.blend(
-        img_pil.convert("RGBA"),
-        paint_mask(combined_mask, color_map=new_color_map).convert("RGBA"),
-        0.5,
+    # Blend half and half with the painted masks
+    overlay_true = (img + PALETTE_TRUE[mask_true]) // 2
+    overlay_pred = (img + PALETTE_PRED[combined_mask]) // 2
+    return Image.fromarray(np.hstack([overlay_true, overlay_pred]).astype(np.uint8))
+
+
+def evaluate_image(mask_pred, mask_fpath, img_fpath=None, n_classes=2):
+    mask_true = np.array(Image.open(mask_fpath), dtype=np.uint8)
+    mask_pred = np.array(
+        Image.fromarray(mask_pred).resize((mask_true.shape[1], mask_true.shape[0])),
+        dtype=np.uint8,
     )
-    stacked_image = stack_images(overlay_img_true, overlay_img_pred)
-    return stacked_image
+    intersection, cardinality = dice_stats(mask_true, mask_pred, n_classes)
+    overlay = None
+    if img_fpath is not None:
+        overlay = get_overlay_image(img_fpath, mask_true, mask_pred)
+    return dice_per_class(intersection, cardinality), overlay
+
+
+def get_codes(learn):
+    # The mask codes are kept by the `AddMaskCodes` item transform, exported
+    # learners have no `dls.vocab`
+    for tfm in learn.dls.after_item.fs:
+        if isinstance(tfm, AddMaskCodes) and tfm.codes is not None:
+            return list(tfm.codes)
+    raise ValueError("The learner has no mask codes")
 
 
 def get_mask_path(x, train_data_dir):
     return Path(train_data_dir) / f"{Path(x).stem}.png"
 
 
+def predict_masks(learn, img_fpaths, chunk_size=None):
+    # Predict a chunk of images at a time, only the current chunk of
+    # predictions is kept in memory
+    chunk_size = chunk_size or max(len(img_fpaths), 1)
+    for start in range(0, len(img_fpaths), chunk_size):
+        stop = start + chunk_size
+        test_dl = learn.dls.test_dl(img_fpaths[start:stop])
+        preds, _ = learn.get_preds(dl=test_dl)
+        yield np.array(preds[:, 1, :] > 0.5, dtype=np.uint8)
+
+
 def evaluate():
     params = ConfigBox(yaml.load(open("params.yaml", encoding="utf-8")))
     model_fpath = Path("models") / "model.pkl"
     learn = load_learner(model_fpath, cpu=False)
-    test_img_fpaths = sorted(get_files(Path("data") / "test_data", extensions=".jpg"))
-    test_dl = learn.dls.test_dl(test_img_fpaths)
-    preds, _ = learn.get_preds(dl=test_dl)
-    masks_pred = np.array(preds[:, 1, :] > 0.5, dtype=np.uint8)
-    test_mask_fpaths = [
-        get_mask_path(fpath, Path("data") / "test_data") for fpath in test_img_fpaths
-    ]
-    masks_true = [Image.open(mask_path) for mask_path in test_mask_fpaths]
-    with Live("results/evaluate") as live:
-        dice_multi = 0.0
-        for ii in range(len(masks_true)):
-            mask_pred, mask_true = masks_pred[ii], masks_true[ii]
-            mask_pred = np.array(
-                Image.fromarray(mask_pred).resize((mask_true.shape[1], mask_true.shape[0])),
-                dtype=int
+    test_img_fpaths = sorted(get_split_files("test"))
+    classes = get_codes(learn)
+    with Live("results/evaluate") as live, ThreadPoolExecutor(params.evaluate.num_workers) as pool:
+        # Running totals, memory does not grow with the number of test images
+        dice_totals = np.zeros(len(classes))
+        dice_images = []
+        ii = 0
+        for masks_pred in predict_masks(learn, test_img_fpaths, params.evaluate.chunk_size):
+            stop = ii + len(masks_pred)
+            img_fpaths = test_img_fpaths[ii:stop]
+            mask_fpaths = [
+                get_mask_path(fpath, Path("data") / "test_data") for fpath in img_fpaths
+            ]
+            # Masks are loaded, resized and scored and the sample images are
+            # rendered on the pool, numpy and PIL release the GIL for the heavy
+            # lifting
+            overlay_fpaths = [
+                fpath if ii + jj < params.evaluate.n_samples_to_save else None
+                for jj, fpath in enumerate(img_fpaths)
+            ]
+            results = pool.map(
+                partial(evaluate_image, n_classes=len(classes)),
+                masks_pred,
+                mask_fpaths,
+                overlay_fpaths,
             )
-            mask_true = np.array(mask_true, dtype=int)
-            dice_multi += dice(mask_true, mask_pred) / len(masks_true)
-
-            if ii < params.evaluate.n_samples_to_save:
-                stacked_image = get_overlay_image(
-                    test_img_fpaths[ii], mask_true, mask_pred
-                )
-                stacked_image = stacked_image.resize((512, 256))
-                live.log_image(f"{Path(test_img_fpaths[ii]).stem}.png", stacked_image)
-
-        live.summary["dice_multi"] = dice_multi
+            for img_fpath, (dice_classes, overlay) in zip(img_fpaths, results):
+                dice_totals += dice_classes
+                dice_images.append((Path(img_fpath).stem, float(dice_classes.mean())))
+
+                if overlay is not None:
+                    live.log_image(f"{Path(img_fpath).stem}.png", overlay)
+                ii += 1
+
+        dice_classes = dice_totals / max(ii, 1)
+        live.summary["dice_multi"] = float(dice_classes.mean())
+        live.summary["dice_per_class"] = dict(zip(classes, dice_classes.tolist()))
+        live.log_plot(
+            "dice_per_image",
+            [{"image": image, "dice": dice} for image, dice in dice_images],
+            x="dice",
+            y="image",
+            template="bar_horizontal",
+        )
 
 
 if __name__ == "__main__":
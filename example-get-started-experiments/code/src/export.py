@@ -0,0 +1,143 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from box import ConfigBox
+from dvclive import Live
+from PIL import Image
+from ruamel.yaml import YAML
+from torchvision.transforms import Compose, Normalize, Resize, ToTensor
+
+from data_split import get_split_files
+from evaluate import dice_per_class, dice_stats, get_mask_path
+
+
+yaml = YAML(typ="safe")
+
+
+class ChannelsLast(torch.nn.Module):
+    # The conversion of the input is part of the traced graph, callers keep
+    # sending contiguous tensors
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def get_transform(img_size):
+    # Same preprocessing as `sagemaker/code/inference.py`
+    return Compose(
+        [
+            Resize(img_size),
+            ToTensor(),
+            Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+        ]
+    )
+
+
+def optimize(model, img_size, channels_last=True):
+    model = model.eval()
+    if channels_last:
+        model = ChannelsLast(model.to(memory_format=torch.channels_last))
+    example = torch.zeros(1, 3, img_size, img_size)
+    with torch.no_grad():
+        # Shape dependent branches of the UNet are fixed by tracing, the traced
+        # module is only valid for inputs of `img_size`
+        traced = torch.jit.trace(model, example)
+        # Inlines the weights, `torch.jit.optimize_for_inference` then folds the
+        # batch norms into the convolutions at load time, its result can not be
+        # saved
+        return torch.jit.freeze(traced.eval())
+
+
+def load_optimized(fpath):
+    # Same as `model_fn` of `sagemaker/code/inference.py`
+    model = torch.jit.load(str(fpath), map_location=torch.device("cpu"))
+    return torch.jit.optimize_for_inference(model)
+
+
+def get_batches(img_fpaths, transform, batch_size):
+    # Images of the same size are stacked into batches of at most `batch_size`,
+    # as `predict_batches` of `sagemaker/code/inference.py` does
+    by_shape = {}
+    for img_fpath in img_fpaths:
+        img_tensor = transform(Image.open(img_fpath).convert("RGB"))
+        by_shape.setdefault(img_tensor.shape, []).append((img_fpath, img_tensor))
+    for items in by_shape.values():
+        for start in range(0, len(items), batch_size):
+            stop = start + batch_size
+            batch_fpaths, img_tensors = zip(*items[start:stop])
+            yield batch_fpaths, torch.stack(img_tensors)
+
+
+def measure(model, img_fpaths, img_size, batch_size):
+    # Mean dice over the test images and mean latency per image of a request of
+    # `batch_size` images
+    transform = get_transform(img_size)
+    dice_totals = np.zeros(2)
+    elapsed = 0.0
+    with torch.no_grad():
+        for batch_fpaths, batch in get_batches(img_fpaths, transform, batch_size):
+            start = time.perf_counter()
+            preds = model(batch)
+            elapsed += time.perf_counter() - start
+            masks_pred = (preds[:, 1] > 0.5).numpy().astype(np.uint8)
+            for img_fpath, mask_pred in zip(batch_fpaths, masks_pred):
+                mask_true = np.array(
+                    Image.open(get_mask_path(img_fpath, Path(img_fpath).parent)),
+                    dtype=np.uint8,
+                )
+                mask_pred = np.array(
+                    Image.fromarray(mask_pred).resize((mask_true.shape[1], mask_true.shape[0])),
+                    dtype=np.uint8,
+                )
+                dice_totals += dice_per_class(*dice_stats(mask_true, mask_pred))
+    n_images = max(len(img_fpaths), 1)
+    return float((dice_totals / n_images).mean()), elapsed / n_images
+
+
+def export():
+    params = ConfigBox(yaml.load(open("params.yaml", encoding="utf-8")))
+    torch.manual_seed(params.base.random_seed)
+    models_dir = Path("models")
+    model = torch.load(
+        models_dir / "model.pth", map_location=torch.device("cpu"), weights_only=False
+    )
+    img_size = params.export.img_size
+    batch_size = params.export.batch_size
+
+    # The saved module is validated as it is served. The input size of the
+    # traced module is saved with it, `model_fn` resizes the images to it.
+    cpu_model_fpath = models_dir / "model_cpu.pt"
+    frozen = optimize(model, img_size, params.export.channels_last)
+    torch.jit.save(frozen, str(cpu_model_fpath), _extra_files={"img_size": str(img_size)})
+    optimized = load_optimized(cpu_model_fpath)
+    test_img_fpaths = sorted(get_split_files("test"))
+    with Live("results/export") as live:
+        # Warm-up, the first calls of a TorchScript module profile and optimize
+        # the graph
+        with torch.no_grad():
+            for _ in range(2):
+                optimized(torch.zeros(batch_size, 3, img_size, img_size))
+        dice_eager, latency_eager = measure(model.eval(), test_img_fpaths, img_size, batch_size)
+        dice_optimized, latency_optimized = measure(
+            optimized, test_img_fpaths, img_size, batch_size
+        )
+        live.summary["dice_eager"] = dice_eager
+        live.summary["dice_optimized"] = dice_optimized
+        live.summary["latency_eager_ms"] = latency_eager * 1000
+        live.summary["latency_optimized_ms"] = latency_optimized * 1000
+
+    if abs(dice_optimized - dice_eager) > params.export.dice_tolerance:
+        cpu_model_fpath.unlink()
+        raise ValueError(
+            f"Dice of the optimized model {dice_optimized:.4f} is not within "
+            f"{params.export.dice_tolerance} of {dice_eager:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    export()
@@ -0,0 +1,134 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from box import ConfigBox
+from fastai.vision.all import PILImage, PILMask
+from PIL import Image
+from ruamel.yaml import YAML
+
+from data_split import get_split_files, read_index
+
+
+yaml = YAML(typ="safe")
+
+# One store per image size, `data/train_cache/<img_size>`
+CACHE_DIR = Path("data") / "train_cache"
+
+
+def get_store_dir(img_size):
+    return CACHE_DIR / str(img_size)
+
+
+def get_sources():
+    # Source files of the training images and the code that resizes them, a
+    # store built from the same sources is reused as it is
+    rows = [row for row in read_index().values() if row["split"] == "train"]
+    if not rows:
+        return None
+    code_digest = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+    return code_digest + "\n" + "".join(f"{row['name']}:{row['source']}\n" for row in rows)
+
+
+def center_crop(img):
+    # Same as the validation crop of `Resize`, the largest centered square
+    width, height = img.size
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    return img.crop((left, top, left + side, top + side))
+
+
+def resize_pair(img_fpath, msk_fpath, img_size):
+    img = center_crop(Image.open(img_fpath).convert("RGB"))
+    msk = center_crop(Image.open(msk_fpath))
+    return (
+        np.asarray(img.resize((img_size, img_size), Image.BILINEAR), dtype=np.uint8),
+        np.asarray(msk.resize((img_size, img_size), Image.NEAREST), dtype=np.uint8),
+    )
+
+
+class CachedItems:
+    # Loads the training items from the store of `preprocess` if it has them,
+    # otherwise decodes the files as before. The arrays are memory-mapped
+    # lazily in every process, so the data loader workers share the pages.
+    # Only the store location is pickled with an exported learner.
+    def __init__(self, store_dir, masks=False):
+        self.store_dir = Path(store_dir)
+        self.masks = masks
+        self.array = None
+        self.positions = None
+
+    def __getstate__(self):
+        return {"store_dir": self.store_dir, "masks": self.masks}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def load(self):
+        self.positions = {}
+        names_fpath = self.store_dir / "names.txt"
+        if names_fpath.exists():
+            names = names_fpath.read_text(encoding="utf-8").splitlines()
+            self.positions = {name: i for i, name in enumerate(names)}
+            array_fname = "masks.npy" if self.masks else "images.npy"
+            self.array = np.load(self.store_dir / array_fname, mmap_mode="r")
+
+    def __call__(self, fpath):
+        if self.positions is None:
+            self.load()
+        i = self.positions.get(Path(fpath).stem)
+        if self.masks:
+            # Items are the image files, masks are next to them
+            mask_fpath = Path(fpath).with_suffix(".png")
+            return PILMask.create(mask_fpath if i is None else self.array[i])
+        return PILImage.create(fpath if i is None else self.array[i])
+
+
+def preprocess():
+    params = ConfigBox(yaml.load(open("params.yaml", encoding="utf-8")))
+    img_size = params.train.img_size
+    img_fpaths = get_split_files("train")
+    msk_fpaths = [Path(fpath).with_suffix(".png") for fpath in img_fpaths]
+
+    # The stores of the other image sizes are kept between runs (`persist: true`
+    # in dvc.yaml, as generate.sh declares it)
+    store_dir = get_store_dir(img_size)
+    sources = get_sources()
+    sources_fpath = store_dir / "sources.txt"
+    if sources is not None and sources_fpath.exists():
+        if sources_fpath.read_text(encoding="utf-8") == sources:
+            return
+    store_dir.mkdir(parents=True, exist_ok=True)
+    sources_fpath.unlink(missing_ok=True)
+    # Decoded and resized once for every epoch of every experiment with the
+    # same image size
+    images = np.lib.format.open_memmap(
+        store_dir / "images.npy",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(img_fpaths), img_size, img_size, 3),
+    )
+    masks = np.lib.format.open_memmap(
+        store_dir / "masks.npy",
+        mode="w+",
+        dtype=np.uint8,
+        shape=(len(img_fpaths), img_size, img_size),
+    )
+
+    def store_pair(i):
+        images[i], masks[i] = resize_pair(img_fpaths[i], msk_fpaths[i], img_size)
+
+    with ThreadPoolExecutor(params.preprocess.num_workers) as pool:
+        list(pool.map(store_pair, range(len(img_fpaths))))
+    images.flush()
+    masks.flush()
+    (store_dir / "names.txt").write_text(
+        "".join(f"{Path(fpath).stem}\n" for fpath in img_fpaths), encoding="utf-8"
+    )
+    if sources is not None:
+        sources_fpath.write_text(sources, encoding="utf-8")
+
+
+if __name__ == "__main__":
+    preprocess()
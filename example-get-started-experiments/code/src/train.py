@@ -1,5 +1,4 @@
 import random
-from functools import partial
 from pathlib import Path
 
 import numpy as np
@@ -7,22 +6,24 @@ import torch
 from box import ConfigBox
 from dvclive import Live
 from dvclive.fastai import DVCLiveCallback
-from fastai.data.all import Normalize, get_files
+from fastai.data.all import Normalize
 from fastai.metrics import DiceMulti
 from fastai.vision.all import (
+    DataBlock,
+    ImageBlock,
+    MaskBlock,
+    RandomSplitter,
     Resize,
-    SegmentationDataLoaders,
     imagenet_stats,
     models,
     unet_learner,
 )
 from ruamel.yaml import YAML
 
-yaml = YAML(typ="safe")
-
+from data_split import get_split_files
+from preprocess import CachedItems, get_store_dir
 
-def get_mask_path(x, train_data_dir):
-    return Path(train_data_dir) / f"{Path(x).stem}.png"
+yaml = YAML(typ="safe")
 
 
 def train():
@@ -33,18 +34,22 @@ def train():
     random.seed(params.base.random_seed)
     train_data_dir = Path("data") / "train_data"
 
-    data_loader = SegmentationDataLoaders.from_label_func(
-        path=train_data_dir,
-        fnames=get_files(train_data_dir, extensions=".jpg"),
-        label_func=partial(get_mask_path, train_data_dir=train_data_dir),
-        codes=["not-pool", "pool"],
-        bs=params.train.batch_size,
-        valid_pct=params.train.valid_pct,
+    # Images and masks are read from the store written by `preprocess`, they
+    # are decoded and resized once instead of at every epoch
+    store_dir = get_store_dir(params.train.img_size)
+    data_block = DataBlock(
+        blocks=(ImageBlock, MaskBlock(codes=["not-pool", "pool"])),
+        get_x=CachedItems(store_dir),
+        get_y=CachedItems(store_dir, masks=True),
+        splitter=RandomSplitter(valid_pct=params.train.valid_pct),
         item_tfms=Resize(params.train.img_size),
         batch_tfms=[
             Normalize.from_stats(*imagenet_stats),
         ],
     )
+    data_loader = data_block.dataloaders(
+        get_split_files("train"), path=train_data_dir, bs=params.train.batch_size
+    )
 
     model_names = [
         name
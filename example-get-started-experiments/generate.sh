@@ -102,24 +102,40 @@ git commit -m "stop tracking results"
 dvc stage add -n data_split \
   -p base,data_split \
   -d src/data_split.py -d data/pool_data \
-  -o data/train_data -o  data/test_data \
+  --outs-persist data/train_data --outs-persist data/test_data \
+  --outs-persist data/split.csv \
   python src/data_split.py
 
+dvc stage add -n preprocess \
+  -p base,preprocess,train.img_size \
+  -d src/preprocess.py -d src/data_split.py -d data/train_data \
+  -d data/split.csv --outs-persist data/train_cache \
+  python src/preprocess.py
+
 dvc remove models/model.pkl.dvc
 dvc stage add -n train \
   -p base,train \
-  -d src/train.py -d data/train_data \
+  -d src/train.py -d src/preprocess.py -d src/data_split.py -d data/train_data \
+  -d data/split.csv -d data/train_cache \
   -o models/model.pkl -o models/model.pth \
   -o results/train python src/train.py
 
 dvc stage add -n evaluate \
   -p base,evaluate \
-  -d src/evaluate.py -d models/model.pkl -d data/test_data \
+  -d src/evaluate.py -d src/data_split.py -d src/preprocess.py -d models/model.pkl \
+  -d data/test_data -d data/split.csv \
   -o results/evaluate python src/evaluate.py
 
+dvc stage add -n export \
+  -p base,export \
+  -d src/export.py -d src/evaluate.py -d src/data_split.py -d src/preprocess.py \
+  -d models/model.pth -d data/test_data -d data/split.csv \
+  -o models/model_cpu.pt \
+  -o results/export python src/export.py
+
 dvc stage add -n sagemaker \
-  -d models/model.pth -o model.tar.gz \
-  'cp models/model.pth sagemaker/code/model.pth && cd sagemaker && tar -cpzf model.tar.gz code/ && cd .. && mv sagemaker/model.tar.gz .  && rm sagemaker/code/model.pth'
+  -d models/model.pth -d models/model_cpu.pt -o model.tar.gz \
+  'cp models/model.pth models/model_cpu.pt sagemaker/code/ && cd sagemaker && tar -cpzf model.tar.gz code/ && cd .. && mv sagemaker/model.tar.gz .  && rm sagemaker/code/model.pth sagemaker/code/model_cpu.pt'
 
 git add .
 tick
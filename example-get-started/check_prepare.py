@@ -0,0 +1,130 @@
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import xml.etree.ElementTree
+
+import yaml
+
+# This file is not part of the project, it checks that the data sets of the
+# prepare stage do not depend on how the input is chunked and parsed
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code", "src")
+sys.path.insert(0, SRC_DIR)
+from prepare import process_posts  # noqa: E402
+
+PARAMS_FILE = os.path.join(os.path.dirname(SRC_DIR), "params.yaml")
+
+
+def prepare(data_file, params, **kwargs):
+    """
+    Prepare the data sets in memory.
+
+    Args:
+        data_file (str): Input XML file.
+        params (dict): Parameters of the prepare stage.
+        **kwargs: Arguments of `process_posts` that override the parameters.
+
+    Returns:
+        tuple: Train and test TSV data sets.
+    """
+    kwargs = {
+        "target_tag": "<r>",
+        "split": params["split"],
+        "seed": params["seed"],
+        "split_mode": params["split_mode"],
+        "workers": params["workers"],
+        "chunk_size": params["chunk_size"],
+        **kwargs,
+    }
+    random.seed(params["seed"])
+    fd_out_train, fd_out_test = io.StringIO(), io.StringIO()
+    with open(data_file, "rb") as fd_in:
+        process_posts(fd_in, fd_out_train, fd_out_test, **kwargs)
+    return fd_out_train.getvalue(), fd_out_test.getvalue()
+
+
+def prepare_serial(data_file, params):
+    """
+    Prepare the data sets with the original single-pass parser of the stage.
+
+    Every line is parsed as an XML element and written in the input order, the
+    train/test assignment is the `random` split mode.
+
+    Args:
+        data_file (str): Input XML file.
+        params (dict): Parameters of the prepare stage.
+
+    Returns:
+        tuple: Train and test TSV data sets.
+    """
+    random.seed(params["seed"])
+    fd_out_train, fd_out_test = io.StringIO(), io.StringIO()
+    num = 1
+    with open(data_file) as fd_in:
+        for line in fd_in:
+            try:
+                fd_out = fd_out_train if random.random() > params["split"] else fd_out_test
+                attr = xml.etree.ElementTree.fromstring(line).attrib
+
+                pid = attr.get("Id", "")
+                label = 1 if "<r>" in attr.get("Tags", "") else 0
+                title = re.sub(r"\s+", " ", attr.get("Title", "")).strip()
+                body = re.sub(r"\s+", " ", attr.get("Body", "")).strip()
+                fd_out.write("{}\t{}\t{}\n".format(pid, label, title + " " + body))
+
+                num += 1
+            except Exception as ex:
+                sys.stderr.write(f"Skipping the broken line {num}: {ex}\n")
+    return fd_out_train.getvalue(), fd_out_test.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the prepared data sets do not depend on the chunking."
+    )
+    parser.add_argument("data_file", help="Input XML file of the prepare stage")
+    parser.add_argument(
+        "--chunk-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 7, 1000, 10000],
+        help="Chunk sizes to compare",
+    )
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2], help="Worker counts to compare"
+    )
+    args = parser.parse_args()
+
+    params = yaml.safe_load(open(PARAMS_FILE))["prepare"]
+    failed = False
+    for split_mode in ("random", "hash"):
+        # The `hash` split mode is new, its outputs are compared to each other
+        if split_mode == "random":
+            expected, reference = prepare_serial(args.data_file, params), "the serial parser"
+        else:
+            expected, reference = None, "the first run"
+        for workers in args.workers:
+            for chunk_size in args.chunk_sizes:
+                output = prepare(
+                    args.data_file,
+                    params,
+                    split_mode=split_mode,
+                    workers=workers,
+                    chunk_size=chunk_size,
+                )
+                if expected is None:
+                    expected = output
+                elif output != expected:
+                    sys.stderr.write(
+                        f"The {split_mode} split with workers={workers} and "
+                        f"chunk_size={chunk_size} differs from {reference}\n"
+                    )
+                    failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
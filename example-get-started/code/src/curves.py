@@ -0,0 +1,175 @@
+import collections
+
+import numpy as np
+
+BinaryCurves = collections.namedtuple("BinaryCurves", ["thresholds", "tps", "fps"])
+BinaryCurves.__doc__ = """
+Cumulative counts of a binary classifier at every distinct score threshold.
+
+Everything the evaluation stage reports is derived from these counts, so the
+scores of a data set are sorted only once.
+
+Attributes:
+    thresholds (numpy.ndarray): Distinct scores, in decreasing order.
+    tps (numpy.ndarray): Number of positive samples scored at least each
+        threshold.
+    fps (numpy.ndarray): Number of negative samples scored at least each
+        threshold.
+"""
+
+
+def binary_curves(labels, scores):
+    """
+    Sort the scores once and count the true and false positives per threshold.
+
+    Args:
+        labels (numpy.ndarray): Binary labels, `1` for the positive class.
+        scores (numpy.ndarray): Scores of the positive class.
+
+    Returns:
+        BinaryCurves: Cumulative counts.
+    """
+    order = np.argsort(scores, kind="mergesort")[::-1]
+    scores = scores[order]
+    labels = labels[order] == 1
+
+    # The last sample of every run of equal scores
+    ends = np.flatnonzero(np.diff(scores))
+    ends = np.append(ends, labels.size - 1)
+    tps = np.cumsum(labels, dtype=np.int64)[ends]
+    fps = ends + 1 - tps
+    return BinaryCurves(scores[ends], tps, fps)
+
+
+def roc_curve(curves, drop_intermediate=True):
+    """
+    Compute the ROC curve the same way `sklearn.metrics.roc_curve` does.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+        drop_intermediate (bool): Whether to drop the thresholds that do not
+            change the shape of the curve.
+
+    Returns:
+        tuple: False positive rates, true positive rates and thresholds.
+    """
+    thresholds, tps, fps = curves
+    if drop_intermediate and len(fps) > 2:
+        keep = np.flatnonzero(
+            np.concatenate([[True], np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), [True]])
+        )
+        thresholds, tps, fps = thresholds[keep], tps[keep], fps[keep]
+
+    # Start the curve at (0, 0)
+    tps = np.concatenate([[0], tps])
+    fps = np.concatenate([[0], fps])
+    thresholds = np.concatenate([[np.inf], thresholds])
+    fpr = fps / fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+    tpr = tps / tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+    return fpr, tpr, thresholds
+
+
+def precision_recall_curve(curves, drop_intermediate=False):
+    """
+    Compute the precision-recall curve the same way
+    `sklearn.metrics.precision_recall_curve` does.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+        drop_intermediate (bool): Whether to drop the thresholds that do not
+            change the recall.
+
+    Returns:
+        tuple: Precisions and recalls, ending with the `(1, 0)` point, and
+            thresholds in increasing order.
+    """
+    thresholds, tps, fps = curves
+    if drop_intermediate and len(fps) > 2:
+        keep = np.flatnonzero(
+            np.concatenate([[True], np.logical_or(np.diff(tps[:-1]), np.diff(tps[1:])), [True]])
+        )
+        thresholds, tps, fps = thresholds[keep], tps[keep], fps[keep]
+
+    predicted = tps + fps
+    precision = np.zeros(tps.shape, dtype=np.float64)
+    np.divide(tps, predicted, out=precision, where=predicted != 0)
+    recall = tps / tps[-1] if tps[-1] > 0 else np.ones(tps.shape, dtype=np.float64)
+    return (
+        np.append(precision[::-1], 1.0),
+        np.append(recall[::-1], 0.0),
+        thresholds[::-1],
+    )
+
+
+def average_precision(curves):
+    """
+    Compute the average precision, the area under the precision-recall step curve.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+
+    Returns:
+        float: Average precision.
+    """
+    precision, recall, _ = precision_recall_curve(curves)
+    return float(-np.sum(np.diff(recall) * precision[:-1]))
+
+
+def roc_auc(curves):
+    """
+    Compute the area under the ROC curve with the trapezoidal rule.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+
+    Returns:
+        float: ROC AUC, NaN if the data set has a single class.
+    """
+    fpr, tpr, _ = roc_curve(curves)
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def confusion_counts(curves, threshold=0.5):
+    """
+    Count the samples of a 2x2 confusion matrix, predicting the positive class
+    for the scores above the threshold.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+        threshold (float): Decision threshold.
+
+    Returns:
+        numpy.ndarray: Counts, actual classes in rows and predicted in columns.
+    """
+    thresholds, tps, fps = curves
+    # Number of distinct scores above the threshold, they are in decreasing order
+    above = np.searchsorted(-thresholds, -threshold, side="left")
+    tp = int(tps[above - 1]) if above else 0
+    fp = int(fps[above - 1]) if above else 0
+    positives = int(tps[-1])
+    negatives = int(fps[-1])
+    return np.array([[negatives - fp, fp], [positives - tp, tp]], dtype=np.int64)
+
+
+def downsample(curves, n_points):
+    """
+    Keep the thresholds at evenly spaced quantiles of the scores.
+
+    Every kept point lies exactly on the full curves and at most
+    `ceil(n_samples / n_points)` samples (plus ties) are scored between two
+    consecutive kept thresholds, which bounds how far the curves drawn through
+    the kept points can be from the full ones.
+
+    Args:
+        curves (BinaryCurves): Cumulative counts.
+        n_points (int): Maximum number of thresholds to keep.
+
+    Returns:
+        BinaryCurves: Cumulative counts at the kept thresholds.
+    """
+    if len(curves.thresholds) <= n_points:
+        return curves
+    predicted = curves.tps + curves.fps
+    quantiles = np.linspace(predicted[-1] / n_points, predicted[-1], n_points)
+    keep = np.unique(np.searchsorted(predicted, quantiles, side="left"))
+    return BinaryCurves(*(array[keep] for array in curves))
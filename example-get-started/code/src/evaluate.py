@@ -1,63 +1,136 @@
-import json
-import math
+import csv
 import os
-import pickle
 import sys
 
-import pandas as pd
-from sklearn import metrics
-from sklearn import tree
+import numpy as np
+import yaml
 from dvclive import Live
-from matplotlib import pyplot as plt
+from dvclive.serialize import dump_json
 
+import curves
+from feature_store import FeatureSet, load_features
+from forest import load_model
 
-def evaluate(model, matrix, split, live, save_path):
+
+def sample_features(features, fraction, seed):
+    """
+    Draw a random sample of the rows of a data set, keeping their order.
+
+    Args:
+        features (feature_store.FeatureSet): Data set.
+        fraction (float): Fraction of the rows to keep, `1` keeps all rows.
+        seed (int): Random seed.
+
+    Returns:
+        feature_store.FeatureSet: Sampled data set.
+    """
+    n_rows = features.x.shape[0]
+    size = int(round(n_rows * fraction))
+    if size >= n_rows:
+        return features
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n_rows, size=size, replace=False))
+    return FeatureSet(features.ids[rows], features.labels[rows], features.x[rows], features.names)
+
+
+def save_plot(live, name, content):
+    """
+    Save the data points of a plot where `Live.log_sklearn_plot` would.
+
+    Args:
+        live (dvclive.Live): Dvclive instance.
+        name (str): Plot name, e.g. `roc/train`.
+        content (dict or list): Data points.
+    """
+    dump_json(content, os.path.join(live.plots_dir, "sklearn", f"{name}.json"))
+
+
+def evaluate(model, features, split, live, save_path, plot_points=0):
     """
     Dump all evaluation metrics and plots for given datasets.
 
     Args:
-        model (sklearn.ensemble.RandomForestClassifier): Trained classifier.
-        matrix (scipy.sparse.csr_matrix): Input matrix.
+        model (sklearn.ensemble.RandomForestClassifier): Trained classifier, or
+            a `forest.CompactForest`.
+        features (feature_store.FeatureSet): Data set.
         split (str): Dataset name.
         live (dvclive.Live): Dvclive instance.
         save_path (str): Path to save the metrics.
+        plot_points (int): Maximum number of thresholds in the ROC and
+            precision recall plots, `0` to keep all of them.
     """
-    labels = matrix[:, 1].toarray().astype(int)
-    x = matrix[:, 2:]
+    predictions = model.predict_proba(features.x)[:, 1]
 
-    predictions_by_class = model.predict_proba(x)
-    predictions = predictions_by_class[:, 1]
+    # Sort the predictions once, all metrics and plots are derived from the
+    # cumulative counts, the same values `sklearn.metrics` computes
+    counts = curves.binary_curves(features.labels, predictions)
 
     # Use dvclive to log a few simple metrics...
-    avg_prec = metrics.average_precision_score(labels, predictions)
-    roc_auc = metrics.roc_auc_score(labels, predictions)
     if not live.summary:
         live.summary = {"avg_prec": {}, "roc_auc": {}}
-    live.summary["avg_prec"][split] = avg_prec
-    live.summary["roc_auc"][split] = roc_auc
-
-    # ... and plots...
+    live.summary["avg_prec"][split] = curves.average_precision(counts)
+    live.summary["roc_auc"][split] = curves.roc_auc(counts)
+
+    # ... and plots, in the format of `Live.log_sklearn_plot`, from a fixed
+    # number of thresholds with large data sets...
+    plot_counts = counts
+    if plot_points:
+        plot_counts = curves.downsample(counts, plot_points)
     # ... like an roc plot...
-    live.log_sklearn_plot("roc", labels, predictions, name=f"roc/{split}")
+    fpr, tpr, thresholds = curves.roc_curve(plot_counts)
+    roc_points = [
+        {"fpr": fp, "tpr": tp, "threshold": t}
+        for fp, tp, t in zip(fpr.tolist(), tpr.tolist(), thresholds.tolist())
+    ]
+    save_plot(live, f"roc/{split}", {"roc": roc_points})
     # ... and precision recall plot...
-    # ... which passes `drop_intermediate=True` to the sklearn method...
-    live.log_sklearn_plot(
-        "precision_recall",
-        labels,
-        predictions,
-        name=f"prc/{split}",
-        drop_intermediate=True,
-    )
-    # ... and confusion matrix plot
-    live.log_sklearn_plot(
-        "confusion_matrix",
-        labels.squeeze(),
-        predictions_by_class.argmax(-1),
-        name=f"cm/{split}",
+    precision, recall, thresholds = curves.precision_recall_curve(
+        plot_counts, drop_intermediate=True
     )
+    prc_points = [
+        {"precision": p, "recall": r, "threshold": t}
+        for p, r, t in zip(precision.tolist(), recall.tolist(), thresholds.tolist())
+    ]
+    save_plot(live, f"prc/{split}", {"precision_recall": prc_points})
+    # ... and confusion matrix plot, one data point per sample, which the
+    # plot template counts
+    confusion = curves.confusion_counts(counts)
+    cm_points = [
+        {"actual": str(actual), "predicted": str(predicted)}
+        for actual in range(2)
+        for predicted in range(2)
+        for _ in range(confusion[actual, predicted])
+    ]
+    save_plot(live, f"cm/{split}", cm_points)
+
+
+def top_importances(importances, k):
+    """
+    Find the `k` largest feature importances without sorting all of them.
+
+    The result is the same as `pandas.Series.nlargest`, ties are broken by
+    feature index.
 
+    Args:
+        importances (numpy.ndarray): Feature importances.
+        k (int): Number of features.
 
-def save_importance_plot(live, model, feature_names):
+    Returns:
+        numpy.ndarray: Feature indices, the most important first.
+    """
+    importances = np.asarray(importances)
+    k = min(k, importances.size)
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    # The k-th largest importance, everything above it is in the top k
+    kth = importances[np.argpartition(importances, importances.size - k)[-k]]
+    above = np.flatnonzero(importances > kth)
+    ties = np.flatnonzero(importances == kth)[: k - above.size]
+    top = np.concatenate([above, ties])
+    return top[np.lexsort((top, -importances[top]))]
+
+
+def save_importance_plot(live, model, feature_names, output_format="png", k=30):
     """
     Save feature importance plot.
 
@@ -65,47 +138,85 @@ def save_importance_plot(live, model, feature_names):
         live (dvclive.Live): DVCLive instance.
         model (sklearn.ensemble.RandomForestClassifier): Trained classifier.
         feature_names (list): List of feature names.
+        output_format (str): `png` image, or `json` or `csv` data points that
+            are much cheaper to write.
+        k (int): Number of most important features to plot.
     """
+    importances = model.feature_importances_
+    top = top_importances(importances, k)
+    names = [feature_names[i] for i in top]
+    values = importances[top].tolist()
+
+    if output_format == "json":
+        live.log_plot(
+            "importance",
+            [{"feature": n, "importance": v} for n, v in zip(names, values)],
+            x="importance",
+            y="feature",
+            template="bar_horizontal_sorted",
+            x_label="Mean decrease in impurity",
+        )
+        return
+    if output_format == "csv":
+        path = os.path.join(live.plots_dir, "custom", "importance.csv")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as fd:
+            writer = csv.writer(fd)
+            writer.writerow(["feature", "importance"])
+            writer.writerows(zip(names, values))
+        return
+    if output_format != "png":
+        raise ValueError(f"Unsupported importance plot format: {output_format}")
+
+    # Importing matplotlib is slow, only do it when the image is needed
+    from matplotlib import pyplot as plt
+
     fig, axes = plt.subplots(dpi=100)
     fig.subplots_adjust(bottom=0.2, top=0.95)
     axes.set_ylabel("Mean decrease in impurity")
-
-    importances = model.feature_importances_
-    forest_importances = pd.Series(importances, index=feature_names).nlargest(n=30)
-    forest_importances.plot.bar(ax=axes)
+    axes.bar(names, values, width=0.5)
+    axes.tick_params(axis="x", labelrotation=90)
 
     live.log_image("importance.png", fig)
+    plt.close(fig)
 
 
 def main():
     EVAL_PATH = "eval"
 
+    params = yaml.safe_load(open("params.yaml"))["evaluate"]
+
     if len(sys.argv) != 3:
         sys.stderr.write("Arguments error. Usage:\n")
         sys.stderr.write("\tpython evaluate.py model features\n")
         sys.exit(1)
 
     model_file = sys.argv[1]
-    train_file = os.path.join(sys.argv[2], "train.pkl")
-    test_file = os.path.join(sys.argv[2], "test.pkl")
+    train_path = os.path.join(sys.argv[2], "train")
+    test_path = os.path.join(sys.argv[2], "test")
 
     # Load model and data.
-    with open(model_file, "rb") as fd:
-        model = pickle.load(fd)
-
-    with open(train_file, "rb") as fd:
-        train, feature_names = pickle.load(fd)
+    model = load_model(model_file)
 
-    with open(test_file, "rb") as fd:
-        test, _ = pickle.load(fd)
+    # The train metrics only show how well the model fits, a sample is enough
+    train = load_features(train_path)
+    train_sample = sample_features(train, params["train_sample"], params["seed"])
+    test = load_features(test_path)
 
     # Evaluate train and test datasets.
     with Live(EVAL_PATH, dvcyaml=False) as live:
-        evaluate(model, train, "train", live, save_path=EVAL_PATH)
-        evaluate(model, test, "test", live, save_path=EVAL_PATH)
+        for features, split in ((train_sample, "train"), (test, "test")):
+            evaluate(
+                model,
+                features,
+                split,
+                live,
+                save_path=EVAL_PATH,
+                plot_points=params["plot_points"],
+            )
 
         # Dump feature importance plot.
-        save_importance_plot(live, model, feature_names)
+        save_importance_plot(live, model, train.names, output_format=params["importance_format"])
 
 
 if __name__ == "__main__":
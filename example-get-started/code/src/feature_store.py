@@ -0,0 +1,162 @@
+import collections
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import scipy.sparse as sparse
+
+# Files of the `npy` format, a directory per data set with raw CSR arrays that
+# are memory-mapped when loaded.
+MANIFEST = "manifest.json"
+ARRAYS = ("data", "indices", "indptr", "ids", "labels")
+
+FeatureSet = collections.namedtuple("FeatureSet", ["ids", "labels", "x", "names"])
+FeatureSet.__doc__ = """
+Data set produced by the featurization stage.
+
+The post ids and labels are kept apart from the feature matrix, so consumers
+never have to slice columns out of it.
+
+Attributes:
+    ids (numpy.ndarray): Post ids, int64.
+    labels (numpy.ndarray): Labels, int64.
+    x (scipy.sparse.csr_matrix): Feature matrix, float32 values and int32
+        indices, the types the random forest works with.
+    names (list): List of feature names.
+"""
+
+
+def make_feature_set(ids, labels, x, names):
+    """
+    Build a feature set converting the arrays to the expected types.
+
+    Args:
+        ids (array-like): Post ids.
+        labels (array-like): Labels.
+        x (scipy.sparse matrix): Feature matrix.
+        names (list): List of feature names.
+
+    Returns:
+        FeatureSet: Feature set.
+    """
+    x = sparse.csr_matrix(x)
+    index_dtype = np.int32 if x.nnz < np.iinfo(np.int32).max else np.int64
+    x = sparse.csr_matrix(
+        (
+            x.data.astype(np.float32, copy=False),
+            x.indices.astype(index_dtype, copy=False),
+            x.indptr.astype(index_dtype, copy=False),
+        ),
+        shape=x.shape,
+        copy=False,
+    )
+    return FeatureSet(
+        ids=np.asarray(ids, dtype=np.int64),
+        labels=np.asarray(labels, dtype=np.int64),
+        x=x,
+        names=[str(name) for name in names],
+    )
+
+
+def save_store(path, features):
+    """
+    Save a feature set as raw `.npy` arrays with a manifest.
+
+    Args:
+        path (str): Output directory.
+        features (FeatureSet): Feature set.
+    """
+    arrays = {
+        "data": features.x.data,
+        "indices": features.x.indices,
+        "indptr": features.x.indptr,
+        "ids": features.ids,
+        "labels": features.labels,
+    }
+
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    manifest = {
+        "format": "csr",
+        "shape": list(features.x.shape),
+        "dtypes": {name: str(array.dtype) for name, array in arrays.items()},
+        "feature_names": features.names,
+    }
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as fd:
+        json.dump(manifest, fd)
+
+
+def load_store(path, mmap_mode="r"):
+    """
+    Load a feature set saved by `save_store`.
+
+    With the default `mmap_mode` nothing is read into memory upfront and the
+    pages of the arrays are shared between all processes that load them.
+
+    Args:
+        path (str): Input directory.
+        mmap_mode (str): Memory-map mode passed to `numpy.load`, `None` to read
+            the arrays into memory.
+
+    Returns:
+        FeatureSet: Feature set.
+    """
+    with open(os.path.join(path, MANIFEST), encoding="utf-8") as fd:
+        manifest = json.load(fd)
+
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS
+    }
+    x = sparse.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(manifest["shape"]),
+        copy=False,
+    )
+    return FeatureSet(arrays["ids"], arrays["labels"], x, manifest["feature_names"])
+
+
+def save_features(path, features):
+    """
+    Save a feature set to a pickle file or, if the path has no `.pkl`
+    extension, to a memory-mappable feature store directory.
+
+    The data set saved in the other format, if any, is removed, so that
+    `load_features` never finds a stale one.
+
+    Args:
+        path (str): Output file or directory name.
+        features (FeatureSet): Feature set.
+    """
+    if not path.endswith(".pkl"):
+        if os.path.exists(path + ".pkl"):
+            os.remove(path + ".pkl")
+        save_store(path, features)
+        return
+
+    store_path = path[: -len(".pkl")]
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+
+    with open(path, "wb") as fd:
+        pickle.dump(tuple(features), fd, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_features(path):
+    """
+    Load a feature set saved by the featurization stage in any supported format.
+
+    Args:
+        path (str): Data set path without an extension, e.g. `data/features/train`.
+
+    Returns:
+        FeatureSet: Feature set.
+    """
+    if os.path.isdir(path):
+        return load_store(path)
+
+    with open(path + ".pkl", "rb") as fd:
+        return FeatureSet(*pickle.load(fd))
@@ -1,48 +1,102 @@
+import collections
+import io
+import itertools
+import json
 import os
-import pickle
+import shutil
 import sys
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import scipy.sparse as sparse
 import yaml
+from sklearn.feature_extraction import FeatureHasher
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 
+from feature_store import make_feature_set, save_features
+from incremental import complete_size, input_position, load_state, resume_offset, save_state
+from parallel import imap
+from vectorizer import apply_idf, compute_idf, make_bag_of_words, save_vectorizer
 
-def get_df(data):
-    """Read the input data file and return a data frame."""
-    df = pd.read_csv(
+
+COLUMNS = ["id", "label", "text"]
+
+
+def is_parquet(data):
+    """Check if the input data file is in the `parquet` format of the prepare stage."""
+    return isinstance(data, str) and data.endswith(".parquet")
+
+
+def get_df(data, name=None):
+    """Read the input data file (or named file object) and return a data frame."""
+    if is_parquet(data):
+        # Only the needed columns are read, the text stays in Arrow buffers
+        df = pq.read_table(data, columns=COLUMNS).to_pandas(
+            types_mapper={pa.string(): pd.ArrowDtype(pa.string())}.get
+        )
+    else:
+        df = pd.read_csv(
+            data,
+            encoding="utf-8",
+            header=None,
+            delimiter="\t",
+            names=COLUMNS,
+        )
+    sys.stderr.write(f"The input data frame {name or data} size is {df.shape}\n")
+    return df
+
+
+def get_df_chunks(data, chunk_size):
+    """Lazily read the input data file in data frames of `chunk_size` rows."""
+    if is_parquet(data):
+        batches = pq.ParquetFile(data).iter_batches(batch_size=chunk_size, columns=COLUMNS)
+        return (
+            batch.to_pandas(types_mapper={pa.string(): pd.ArrowDtype(pa.string())}.get)
+            for batch in batches
+        )
+    return pd.read_csv(
         data,
         encoding="utf-8",
         header=None,
         delimiter="\t",
-        names=["id", "label", "text"],
+        names=COLUMNS,
+        chunksize=chunk_size,
     )
-    sys.stderr.write(f"The input data frame {data} size is {df.shape}\n")
-    return df
+
+
+def find_input(path, name):
+    """
+    Find an input data file of the prepare stage, in either format.
+
+    Args:
+        path (str): Input directory.
+        name (str): Data set name, `train` or `test`.
+
+    Returns:
+        str: Input file name, the `.parquet` file if there is one.
+    """
+    parquet = os.path.join(path, f"{name}.parquet")
+    return parquet if os.path.exists(parquet) else os.path.join(path, f"{name}.tsv")
 
 
 def save_matrix(df, matrix, names, output):
     """
-    Save the matrix to a pickle file.
+    Save the matrix with the ids and labels as a feature set.
 
     Args:
         df (pandas.DataFrame): Input data frame.
         matrix (scipy.sparse.csr_matrix): Input matrix.
         names (list): List of feature names.
-        output (str): Output file name.
+        output (str): Output file name, a `.pkl` file or a feature store directory.
     """
-    id_matrix = sparse.csr_matrix(df.id.astype(np.int64)).T
-    label_matrix = sparse.csr_matrix(df.label.astype(np.int64)).T
-
-    result = sparse.hstack([id_matrix, label_matrix, matrix], format="csr")
+    features = make_feature_set(df.id, df.label, matrix, names)
 
     msg = "The output matrix {} size is {} and data type is {}\n"
-    sys.stderr.write(msg.format(output, result.shape, result.dtype))
+    sys.stderr.write(msg.format(output, features.x.shape, features.x.dtype))
 
-    with open(output, "wb") as fd:
-        pickle.dump((result, names), fd)
-    pass
+    save_features(output, features)
 
 
 def generate_and_save_train_features(train_input, train_output, bag_of_words, tfidf):
@@ -54,6 +108,9 @@ def generate_and_save_train_features(train_input, train_output, bag_of_words, tf
         train_output (str): Train output file name.
         bag_of_words (sklearn.feature_extraction.text.CountVectorizer): Bag of words.
         tfidf (sklearn.feature_extraction.text.TfidfTransformer): TF-IDF transformer.
+
+    Returns:
+        tuple: Input data frame and the term count matrix.
     """
     df_train = get_df(train_input)
     train_words = np.array(df_train.text.str.lower().values)
@@ -68,6 +125,8 @@ def generate_and_save_train_features(train_input, train_output, bag_of_words, tf
 
     save_matrix(df_train, train_words_tfidf_matrix, feature_names, train_output)
 
+    return df_train, train_words_binary_matrix
+
 
 def generate_and_save_test_features(test_input, test_output, bag_of_words, tfidf):
     """
@@ -78,6 +137,9 @@ def generate_and_save_test_features(test_input, test_output, bag_of_words, tfidf
         test_output (str): Test output file name.
         bag_of_words (sklearn.feature_extraction.text.CountVectorizer): Bag of words.
         tfidf (sklearn.feature_extraction.text.TfidfTransformer): TF-IDF transformer.
+
+    Returns:
+        tuple: Input data frame and the term count matrix.
     """
     df_test = get_df(test_input)
     test_words = np.array(df_test.text.str.lower().values)
@@ -88,6 +150,301 @@ def generate_and_save_test_features(test_input, test_output, bag_of_words, tfidf
 
     save_matrix(df_test, test_words_tfidf_matrix, feature_names, test_output)
 
+    return df_test, test_words_binary_matrix
+
+
+def hash_chunk(df, bag_of_words, with_names):
+    """
+    Hash a chunk of the input data into a term count matrix.
+
+    Args:
+        df (pandas.DataFrame): Chunk of the input data frame.
+        bag_of_words (sklearn.feature_extraction.text.HashingVectorizer): Hashing
+            vectorizer, with `alternate_sign=False` and `norm=None`.
+        with_names (bool): Whether to collect the most frequent term per column.
+
+    Returns:
+        tuple: Ids and labels data frame, term count matrix and a
+            `{column: (term, count)}` dict of the most frequent terms or `None`.
+    """
+    analyzer = bag_of_words.build_analyzer()
+    # Same hashing as `bag_of_words.transform`, but the analyzed terms are kept
+    hasher = FeatureHasher(
+        n_features=bag_of_words.n_features,
+        input_type="string",
+        dtype=bag_of_words.dtype,
+        alternate_sign=False,
+    )
+    docs = [analyzer(text) for text in df.text.str.lower().values]
+    counts = hasher.transform(docs)
+    if not with_names:
+        return df[["id", "label"]], counts, None
+
+    terms = collections.Counter(itertools.chain.from_iterable(docs))
+    columns = hasher.transform([term] for term in terms).indices
+    top_terms = {}
+    for (term, count), column in zip(terms.items(), columns):
+        if column not in top_terms or count > top_terms[column][1]:
+            top_terms[column] = (term, count)
+    return df[["id", "label"]], counts, top_terms
+
+
+def merge_top_terms(top_terms, chunk_top_terms):
+    """
+    Merge the most frequent terms per column of a chunk into the running ones.
+
+    Only the top term of every column is kept, so the result is approximate.
+
+    Args:
+        top_terms (dict): Running `{column: (term, count)}` dict, updated in place.
+        chunk_top_terms (dict): `{column: (term, count)}` dict of a chunk.
+    """
+    for column, (term, count) in chunk_top_terms.items():
+        best = top_terms.get(column)
+        if best is not None and best[0] == term:
+            top_terms[column] = (term, best[1] + count)
+        elif best is None or count > best[1]:
+            top_terms[column] = (term, count)
+
+
+def generate_and_save_hashed_features(
+    input,
+    output,
+    bag_of_words,
+    tfidf,
+    feature_names=None,
+    chunk_size=10000,
+    workers=1,
+):
+    """
+    Generate a feature matrix with the hashing trick, without a fitted vocabulary.
+
+    The input is read in chunks that are hashed independently on a pool of
+    workers, so only the sparse matrices, never the whole text, are in memory.
+
+    Args:
+        input (str): Input file name.
+        output (str): Output file name.
+        bag_of_words (sklearn.feature_extraction.text.HashingVectorizer): Hashing
+            vectorizer, with `alternate_sign=False` and `norm=None`.
+        tfidf (sklearn.feature_extraction.text.TfidfTransformer): TF-IDF
+            transformer, fitted here if `feature_names` is not given.
+        feature_names (list): Feature names of the train data set. If not given
+            the input is the train data set and approximate names (the most
+            frequent term of every column) are collected from it.
+        chunk_size (int): Number of rows hashed at once.
+        workers (int): Number of worker processes, `-1` to use all cores.
+
+    Returns:
+        tuple: Ids and labels data frame, term count matrix and feature names.
+    """
+    fit = feature_names is None
+    frames, matrices, top_terms = [], [], {}
+    chunks = get_df_chunks(input, chunk_size)
+    for df, counts, chunk_top_terms in imap(hash_chunk, chunks, workers, bag_of_words, fit):
+        frames.append(df)
+        matrices.append(counts)
+        if fit:
+            merge_top_terms(top_terms, chunk_top_terms)
+
+    df = pd.concat(frames, ignore_index=True)
+    counts = sparse.vstack(matrices, format="csr")
+    sys.stderr.write(f"The input data frame {input} size is {df.shape}\n")
+
+    if fit:
+        feature_names = np.array(
+            [
+                top_terms[column][0] if column in top_terms else f"hash_{column}"
+                for column in range(bag_of_words.n_features)
+            ],
+            dtype=object,
+        )
+        tfidf.fit(counts)
+    tfidf_matrix = tfidf.transform(counts)
+
+    save_matrix(df, tfidf_matrix, feature_names, output)
+
+    return df, counts, feature_names
+
+
+def count_terms(bag_of_words, texts, term_counts=None):
+    """
+    Count every term of the texts, before the vocabulary is limited.
+
+    Args:
+        bag_of_words (sklearn.feature_extraction.text.CountVectorizer): Bag of words.
+        texts (iterable): Lowercase texts.
+        term_counts (collections.Counter): Running counts, updated in place.
+
+    Returns:
+        collections.Counter: Number of occurrences of every term.
+    """
+    analyzer = bag_of_words.build_analyzer()
+    term_counts = collections.Counter() if term_counts is None else term_counts
+    for text in texts:
+        term_counts.update(analyzer(text))
+    return term_counts
+
+
+def select_vocabulary(term_counts, max_features):
+    """
+    Select the vocabulary the way `CountVectorizer` limits it to `max_features`.
+
+    The most frequent terms are kept. The counts are sorted the same way, in
+    alphabetical term order with the same unstable sort, so the ties at the
+    limit are broken the same way too.
+
+    Args:
+        term_counts (dict): Number of occurrences of every term.
+        max_features (int): Size of the vocabulary, `None` for all terms.
+
+    Returns:
+        list: Terms of the vocabulary in alphabetical order.
+    """
+    terms = sorted(term_counts)
+    counts = np.array([term_counts[term] for term in terms], dtype=np.int64)
+    order = (-counts).argsort()[:max_features]
+    return sorted(terms[i] for i in order)
+
+
+def save_state_dir(state_dir, state, vocabulary, doc_freq, splits, term_counts=None):
+    """
+    Save everything an incremental run needs to featurize only the new rows.
+
+    Args:
+        state_dir (str): State directory.
+        state (dict): Params, input positions and the number of train documents.
+        vocabulary (list): Terms in the feature matrix column order.
+        doc_freq (numpy.ndarray): Number of train documents containing each term.
+        splits (dict): `(data frame, term count matrix)` for each split name.
+        term_counts (dict): Number of occurrences of every train term, before
+            the vocabulary is limited, for the count vectorizer.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    if term_counts is not None:
+        with open(os.path.join(state_dir, "term_counts.json"), "w", encoding="utf-8") as fd:
+            json.dump(term_counts, fd)
+    with open(os.path.join(state_dir, "vocabulary.json"), "w", encoding="utf-8") as fd:
+        json.dump(list(vocabulary), fd)
+    np.save(os.path.join(state_dir, "doc_freq.npy"), doc_freq)
+    for name, (df, counts) in splits.items():
+        np.save(os.path.join(state_dir, f"{name}_ids.npy"), df.id.astype(np.int64))
+        np.save(os.path.join(state_dir, f"{name}_labels.npy"), df.label.astype(np.int64))
+        sparse.save_npz(os.path.join(state_dir, f"{name}_counts.npz"), counts)
+    save_state(os.path.join(state_dir, "state.json"), state)
+
+
+def update_and_save_features(
+    inputs, outputs, bag_of_words, tfidf, state_dir, state, vectorizer_path
+):
+    """
+    Tokenize only the rows appended to the inputs since the last run.
+
+    The counts of all train terms and the document frequencies are updated with
+    the new train rows. The existing rows are reweighted from their saved term
+    counts, their text is not processed again. If the new rows change which
+    terms make the vocabulary, nothing is saved and the caller refits all.
+
+    Only the tokenization is incremental. The new rows change the IDF weights
+    of every row, so the feature matrices are rewritten as a whole, and the term
+    counts and the state files are reloaded and saved again. That work still
+    grows with the size of the data set, but it is much cheaper than analyzing
+    all the texts again.
+
+    Args:
+        inputs (dict): Input file name for each split name.
+        outputs (dict): Output file name for each split name.
+        bag_of_words (sklearn.feature_extraction.text.CountVectorizer): Bag of
+            words, or a hashing vectorizer.
+        tfidf (sklearn.feature_extraction.text.TfidfTransformer): TF-IDF transformer.
+        state_dir (str): State directory.
+        state (dict): State saved by the last run.
+        vectorizer_path (str): Output directory of the updated vectorizer.
+
+    Returns:
+        bool: Whether the features were updated, `False` if the vocabulary
+            changes.
+    """
+    with open(os.path.join(state_dir, "vocabulary.json"), encoding="utf-8") as fd:
+        vocabulary = json.load(fd)
+    term_counts = None
+    if isinstance(bag_of_words, CountVectorizer):
+        term_counts_path = os.path.join(state_dir, "term_counts.json")
+        if not os.path.exists(term_counts_path):
+            return False
+        with open(term_counts_path, encoding="utf-8") as fd:
+            term_counts = collections.Counter(json.load(fd))
+        max_features = bag_of_words.max_features
+        bag_of_words.set_params(vocabulary=vocabulary)
+    doc_freq = np.load(os.path.join(state_dir, "doc_freq.npy"))
+    n_docs = state["n_docs"]
+
+    splits = {}
+    for name, input in inputs.items():
+        ids = np.load(os.path.join(state_dir, f"{name}_ids.npy"))
+        labels = np.load(os.path.join(state_dir, f"{name}_labels.npy"))
+        counts = sparse.load_npz(os.path.join(state_dir, f"{name}_counts.npz"))
+
+        with open(input, "rb") as fd:
+            start = state["inputs"][name]["offset"]
+            end = complete_size(fd)
+            fd.seek(start)
+            new_data = fd.read(end - start)
+            state["inputs"][name] = input_position(fd, end)
+
+        if new_data:
+            df_new = get_df(io.BytesIO(new_data), name=f"{input} (new rows)")
+            new_words = np.array(df_new.text.str.lower().values)
+            if name == "train" and term_counts is not None:
+                count_terms(bag_of_words, new_words, term_counts)
+                if select_vocabulary(term_counts, max_features) != vocabulary:
+                    sys.stderr.write("The vocabulary changes, refitting all\n")
+                    return False
+            new_counts = bag_of_words.transform(new_words)
+            if name == "train":
+                doc_freq += np.bincount(new_counts.indices, minlength=len(vocabulary))
+                n_docs += new_counts.shape[0]
+            ids = np.concatenate([ids, df_new.id.astype(np.int64)])
+            labels = np.concatenate([labels, df_new.label.astype(np.int64)])
+            counts = sparse.vstack([counts, new_counts], format="csr")
+
+        splits[name] = (pd.DataFrame({"id": ids, "label": labels}), counts)
+
+    state["n_docs"] = n_docs
+    idf = compute_idf(doc_freq, n_docs, tfidf.smooth_idf)
+    for name, (df, counts) in splits.items():
+        matrix = apply_idf(counts, idf)
+        save_matrix(df, matrix, np.array(vocabulary, dtype=object), outputs[name])
+    save_vectorizer(vectorizer_path, bag_of_words, idf)
+
+    save_state_dir(state_dir, state, vocabulary, doc_freq, splits, term_counts)
+    return True
+
+
+def can_resume(inputs, state, params):
+    """
+    Check if the inputs were only appended to since the last incremental run.
+
+    Args:
+        inputs (dict): Input file name for each split name.
+        state (dict): State saved by the last run or `None`.
+        params (dict): Featurization params.
+
+    Returns:
+        bool: Whether only the new rows can be featurized.
+    """
+    if not state:
+        sys.stderr.write("No state of a previous incremental run, featurizing all\n")
+        return False
+    if state["params"] != params:
+        return False
+    for name, input in inputs.items():
+        position = state["inputs"][name]
+        with open(input, "rb") as fd:
+            if resume_offset(fd, position) != position["offset"]:
+                return False
+    return True
+
 
 def main():
     params = yaml.safe_load(open("params.yaml"))["featurize"]
@@ -102,33 +459,114 @@ def main():
     in_path = sys.argv[1]
     out_path = sys.argv[2]
 
-    train_input = os.path.join(in_path, "train.tsv")
-    test_input = os.path.join(in_path, "test.tsv")
-    train_output = os.path.join(out_path, "train.pkl")
-    test_output = os.path.join(out_path, "test.pkl")
+    train_input = find_input(in_path, "train")
+    test_input = find_input(in_path, "test")
+    # The `pickle` format saves `.pkl` files, the `npy` format saves directories
+    # of raw arrays that `train.py` and `evaluate.py` memory-map
+    if params["format"] not in ("pickle", "npy"):
+        raise ValueError(f"Unsupported features format: {params['format']}")
+    extension = ".pkl" if params["format"] == "pickle" else ""
+    train_output = os.path.join(out_path, "train" + extension)
+    test_output = os.path.join(out_path, "test" + extension)
 
     max_features = params["max_features"]
     ngrams = params["ngrams"]
 
     os.makedirs(out_path, exist_ok=True)
 
-    bag_of_words = CountVectorizer(
-        stop_words="english", max_features=max_features, ngram_range=(1, ngrams)
-    )
-    tfidf = TfidfTransformer(smooth_idf=False)
-
-    generate_and_save_train_features(
-        train_input=train_input,
-        train_output=train_output,
-        bag_of_words=bag_of_words,
-        tfidf=tfidf,
-    )
-
-    generate_and_save_test_features(
-        test_input=test_input,
-        test_output=test_output,
-        bag_of_words=bag_of_words,
-        tfidf=tfidf,
+    vectorizer = params["vectorizer"]
+    bag_of_words = make_bag_of_words(vectorizer, max_features, ngrams)
+    # Hashed columns might be empty in the train data set, smoothing keeps their
+    # weights finite
+    tfidf = TfidfTransformer(smooth_idf=vectorizer == "hashing")
+
+    # In the incremental mode the output directory has to be persisted between
+    # runs (`persist: true` in dvc.yaml, as generate.sh declares it), only rows
+    # appended to the inputs since the last run are tokenized then.
+    incremental = params["incremental"]
+    if incremental and is_parquet(train_input):
+        raise ValueError("The incremental mode needs the tsv format of the inputs")
+    inputs = {"train": train_input, "test": test_input}
+    outputs = {"train": train_output, "test": test_output}
+    state_dir = os.path.join(out_path, "state")
+    # The fitted vectorizer, to featurize new posts without refitting it
+    vectorizer_path = os.path.join(out_path, "vectorizer")
+    vocab_params = {
+        "max_features": max_features,
+        "ngrams": ngrams,
+        "vectorizer": vectorizer,
+    }
+    state = load_state(os.path.join(state_dir, "state.json")) if incremental else None
+
+    if incremental and can_resume(inputs, state, vocab_params):
+        if update_and_save_features(
+            inputs, outputs, bag_of_words, tfidf, state_dir, state, vectorizer_path
+        ):
+            return
+        bag_of_words = make_bag_of_words(vectorizer, max_features, ngrams)
+
+    if vectorizer == "hashing":
+        df_train, train_counts, feature_names = generate_and_save_hashed_features(
+            input=train_input,
+            output=train_output,
+            bag_of_words=bag_of_words,
+            tfidf=tfidf,
+            chunk_size=params["chunk_size"],
+            workers=params["workers"],
+        )
+
+        df_test, test_counts, _ = generate_and_save_hashed_features(
+            input=test_input,
+            output=test_output,
+            bag_of_words=bag_of_words,
+            tfidf=tfidf,
+            feature_names=feature_names,
+            chunk_size=params["chunk_size"],
+            workers=params["workers"],
+        )
+    else:
+        df_train, train_counts = generate_and_save_train_features(
+            train_input=train_input,
+            train_output=train_output,
+            bag_of_words=bag_of_words,
+            tfidf=tfidf,
+        )
+
+        df_test, test_counts = generate_and_save_test_features(
+            test_input=test_input,
+            test_output=test_output,
+            bag_of_words=bag_of_words,
+            tfidf=tfidf,
+        )
+        feature_names = bag_of_words.get_feature_names_out()
+
+    save_vectorizer(vectorizer_path, bag_of_words, tfidf.idf_)
+
+    if not incremental:
+        shutil.rmtree(state_dir, ignore_errors=True)
+        return
+
+    # Counts of all train terms, to know when new rows change the vocabulary
+    term_counts = None
+    if vectorizer == "count":
+        term_counts = count_terms(bag_of_words, df_train.text.str.lower().values)
+
+    positions = {}
+    for name, input in inputs.items():
+        with open(input, "rb") as fd:
+            positions[name] = input_position(fd, complete_size(fd))
+    state = {
+        "params": vocab_params,
+        "inputs": positions,
+        "n_docs": train_counts.shape[0],
+    }
+    save_state_dir(
+        state_dir,
+        state,
+        vocabulary=feature_names,
+        doc_freq=np.bincount(train_counts.indices, minlength=len(feature_names)),
+        splits={"train": (df_train, train_counts), "test": (df_test, test_counts)},
+        term_counts=term_counts,
     )
 
 
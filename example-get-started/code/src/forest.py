@@ -0,0 +1,280 @@
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import scipy.sparse as sparse
+from sklearn.tree._tree import NODE_DTYPE, TREE_UNDEFINED, Tree
+
+# Files of the `forest` model format, a directory with the nodes of all trees
+# concatenated into flat arrays that are memory-mapped when loaded and turned
+# back into trees when the model first predicts.
+MANIFEST = "forest.json"
+ARRAYS = (
+    "roots",
+    "children_left",
+    "children_right",
+    "feature",
+    "threshold",
+    "value",
+    "feature_importances",
+)
+
+
+def round_down_float32(values):
+    """
+    Round float64 values down to the closest float32 values.
+
+    A float32 sample is at most a threshold if and only if it is at most the
+    threshold rounded down, so the trees predict exactly the same.
+
+    Args:
+        values (numpy.ndarray): Float64 values.
+
+    Returns:
+        numpy.ndarray: Float32 values.
+    """
+    rounded = values.astype(np.float32)
+    above = rounded.astype(np.float64) > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def save_forest(path, clf):
+    """
+    Save a random forest classifier in the compact `forest` format.
+
+    Only what prediction needs is kept: int32 child and feature indices,
+    float32 thresholds and the float64 class probabilities of every node, as
+    scikit-learn averages them.
+
+    Args:
+        path (str): Output directory.
+        clf (sklearn.ensemble.RandomForestClassifier): Trained classifier.
+    """
+    trees = [estimator.tree_ for estimator in clf.estimators_]
+    sizes = np.array([tree.node_count for tree in trees], dtype=np.int64)
+    roots = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    def concatenate(name, offsets=False):
+        arrays = [getattr(tree, name) for tree in trees]
+        if offsets:
+            # Global node indices, leaves keep -1
+            arrays = [
+                np.where(array >= 0, array + root, array) for array, root in zip(arrays, roots)
+            ]
+        return np.concatenate(arrays)
+
+    value = concatenate("value")[:, 0, :]
+    value = value / value.sum(axis=1, keepdims=True)
+    children_left = concatenate("children_left", offsets=True)
+    children_right = concatenate("children_right", offsets=True)
+    arrays = {
+        "roots": roots,
+        "children_left": children_left.astype(np.int32),
+        "children_right": children_right.astype(np.int32),
+        "feature": concatenate("feature").astype(np.int32),
+        "threshold": round_down_float32(concatenate("threshold")),
+        "value": value,
+        "feature_importances": clf.feature_importances_,
+    }
+
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    manifest = {
+        "n_features": int(clf.n_features_in_),
+        "classes": clf.classes_.tolist(),
+        "n_trees": len(trees),
+        "n_nodes": int(sizes.sum()),
+    }
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as fd:
+        json.dump(manifest, fd)
+
+
+def build_tree(n_features, children_left, children_right, feature, threshold, value):
+    """
+    Build a scikit-learn tree from the arrays of a single tree.
+
+    Only the fields prediction needs are set, so the tree predicts exactly as
+    the trained one with the compiled traversal of scikit-learn.
+
+    Args:
+        n_features (int): Number of features.
+        children_left (numpy.ndarray): Left child of every node, -1 for leaves.
+        children_right (numpy.ndarray): Right child of every node.
+        feature (numpy.ndarray): Split feature of every node.
+        threshold (numpy.ndarray): Split threshold of every node.
+        value (numpy.ndarray): Class probabilities of every node.
+
+    Returns:
+        sklearn.tree._tree.Tree: Tree.
+    """
+    leaf = children_left < 0
+    nodes = np.zeros(len(children_left), dtype=NODE_DTYPE)
+    nodes["left_child"] = children_left
+    nodes["right_child"] = children_right
+    nodes["feature"] = np.where(leaf, TREE_UNDEFINED, feature)
+    nodes["threshold"] = np.where(leaf, TREE_UNDEFINED, threshold)
+    tree = Tree(n_features, np.array([value.shape[1]], dtype=np.intp), 1)
+    tree.__setstate__(
+        {
+            "max_depth": 0,
+            "node_count": len(nodes),
+            "nodes": nodes,
+            "values": np.asarray(value, dtype=np.float64)[:, np.newaxis, :],
+        }
+    )
+    return tree
+
+
+class CompactForest:
+    """
+    Lightweight random forest predictor over the arrays saved by `save_forest`.
+
+    It supports what the evaluation and scoring stages use from
+    `RandomForestClassifier`: `predict_proba`, `classes_` and
+    `feature_importances_`. Loading only maps the arrays. The trees are built
+    from them on the first prediction and walked by the compiled traversal of
+    scikit-learn, as fast as the pickled classifier. Building copies the nodes
+    into the scikit-learn trees, so the predicting processes do not share that
+    memory.
+    """
+
+    def __init__(self, manifest, arrays):
+        self.n_features_in_ = manifest["n_features"]
+        self.classes_ = np.array(manifest["classes"])
+        self.feature_importances_ = arrays["feature_importances"]
+        self.roots = np.asarray(arrays["roots"])
+        self.arrays = arrays
+        self._trees = None
+
+    @property
+    def trees(self):
+        """list: Scikit-learn trees, built from the arrays on first use."""
+        if self._trees is None:
+            arrays = self.arrays
+            ends = np.append(self.roots[1:], len(arrays["feature"]))
+            self._trees = []
+            for root, end in zip(self.roots, ends):
+                # Back to the node indices of the tree, leaves keep -1
+                children = [
+                    np.asarray(arrays[name][root:end], dtype=np.intp)
+                    for name in ("children_left", "children_right")
+                ]
+                children = [np.where(child >= 0, child - root, child) for child in children]
+                self._trees.append(
+                    build_tree(
+                        self.n_features_in_,
+                        *children,
+                        arrays["feature"][root:end],
+                        arrays["threshold"][root:end],
+                        arrays["value"][root:end],
+                    )
+                )
+        return self._trees
+
+    def check_input(self, x):
+        # The trees compare float32 samples, the thresholds are rounded for it
+        if sparse.issparse(x):
+            return sparse.csr_matrix(x, dtype=np.float32)
+        return np.ascontiguousarray(x, dtype=np.float32)
+
+    def apply(self, x):
+        """
+        Find the leaf of every tree for every sample.
+
+        Args:
+            x (scipy.sparse.csr_matrix or numpy.ndarray): Samples.
+
+        Returns:
+            numpy.ndarray: Global leaf indices, shape `(n_samples, n_trees)`.
+        """
+        x = self.check_input(x)
+        return np.column_stack(
+            [tree.apply(x) + root for tree, root in zip(self.trees, self.roots)]
+        )
+
+    def predict_proba(self, x, batch_size=10000):
+        """
+        Predict class probabilities, the mean over all trees.
+
+        Args:
+            x (scipy.sparse.csr_matrix or numpy.ndarray): Samples.
+            batch_size (int): Number of samples converted to float32 at once.
+
+        Returns:
+            numpy.ndarray: Class probabilities, shape `(n_samples, n_classes)`.
+        """
+        result = np.zeros((x.shape[0], len(self.classes_)), dtype=np.float64)
+        for start in range(0, x.shape[0], batch_size):
+            stop = start + batch_size
+            batch = self.check_input(x[start:stop])
+            for tree in self.trees:
+                result[start:stop] += tree.predict(batch).reshape(batch.shape[0], -1)
+        return result / len(self.trees)
+
+    def predict(self, x):
+        """Predict classes of the samples."""
+        return self.classes_[self.predict_proba(x).argmax(axis=1)]
+
+
+def load_forest(path, mmap_mode="r"):
+    """
+    Load a forest saved by `save_forest`.
+
+    Args:
+        path (str): Input directory.
+        mmap_mode (str): Memory-map mode passed to `numpy.load`, `None` to read
+            the arrays into memory.
+
+    Returns:
+        CompactForest: Predictor.
+    """
+    with open(os.path.join(path, MANIFEST), encoding="utf-8") as fd:
+        manifest = json.load(fd)
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS
+    }
+    return CompactForest(manifest, arrays)
+
+
+def save_model(path, clf, model_format="pickle"):
+    """
+    Save a trained classifier.
+
+    Args:
+        path (str): Output file or directory name.
+        clf (sklearn.ensemble.RandomForestClassifier): Trained classifier.
+        model_format (str): `pickle` or the compact `forest` directory format.
+    """
+    if model_format not in ("pickle", "forest"):
+        raise ValueError(f"Unsupported model format: {model_format}")
+    # A model saved in the other format is a file or a directory of the same name
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if model_format == "forest":
+        save_forest(path, clf)
+        return
+    with open(path, "wb") as fd:
+        pickle.dump(clf, fd)
+
+
+def load_model(path):
+    """
+    Load a classifier saved by the train stage in any supported format.
+
+    Args:
+        path (str): Model file or directory name.
+
+    Returns:
+        sklearn.ensemble.RandomForestClassifier or CompactForest: Classifier.
+    """
+    if os.path.isdir(path):
+        return load_forest(path)
+    with open(path, "rb") as fd:
+        return pickle.load(fd)
@@ -0,0 +1,133 @@
+import json
+import os
+
+# Number of bytes before the saved offset used to check that an input file was
+# only appended to since the last run.
+TAIL_SIZE = 256
+
+
+def load_state(path):
+    """
+    Load the state saved by the previous incremental run.
+
+    Args:
+        path (str): State file name.
+
+    Returns:
+        dict: Saved state or `None` if there is no state.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as fd:
+        return json.load(fd)
+
+
+def save_state(path, state):
+    """
+    Save the state for the next incremental run.
+
+    The file is replaced atomically, so an interrupted run never leaves a
+    partially written state behind.
+
+    Args:
+        path (str): State file name.
+        state (dict): JSON serializable state.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fd:
+        json.dump(state, fd)
+    os.replace(tmp_path, path)
+
+
+def get_tail(fd, offset):
+    """
+    Read the bytes right before the offset in a binary file.
+
+    Args:
+        fd (file): Input file opened in binary mode.
+        offset (int): Byte offset.
+
+    Returns:
+        str: Hex encoded bytes.
+    """
+    start = max(0, offset - TAIL_SIZE)
+    fd.seek(start)
+    return fd.read(offset - start).hex()
+
+
+def input_position(fd, offset):
+    """
+    Describe the position up to which an input file has been processed.
+
+    Args:
+        fd (file): Input file opened in binary mode.
+        offset (int): Byte offset.
+
+    Returns:
+        dict: Offset and the bytes right before it, see `resume_offset`.
+    """
+    return {"offset": offset, "tail": get_tail(fd, offset)}
+
+
+def resume_offset(fd, position):
+    """
+    Find the offset to resume reading an input file from.
+
+    Args:
+        fd (file): Input file opened in binary mode.
+        position (dict): Position saved by `input_position` or `None`.
+
+    Returns:
+        int: Saved offset if the file was only appended to since, `0` if it has
+            to be processed from scratch.
+    """
+    if not position:
+        return 0
+    offset = position["offset"]
+    if os.fstat(fd.fileno()).st_size < offset:
+        return 0
+    if get_tail(fd, offset) != position["tail"]:
+        return 0
+    return offset
+
+
+def complete_size(fd):
+    """
+    Find the size of a binary file without its trailing incomplete line.
+
+    Args:
+        fd (file): Input file opened in binary mode.
+
+    Returns:
+        int: Offset right after the last newline.
+    """
+    end = os.fstat(fd.fileno()).st_size
+    while end > 0:
+        start = max(0, end - 65536)
+        fd.seek(start)
+        pos = fd.read(end - start).rfind(b"\n")
+        if pos >= 0:
+            return start + pos + 1
+        end = start
+    return 0
+
+
+def read_lines(fd, start, end):
+    """
+    Lazily read the lines between two offsets of a binary file.
+
+    Args:
+        fd (file): Input file opened in binary mode.
+        start (int): Offset of the first line.
+        end (int): Offset right after the last line.
+
+    Yields:
+        bytes: Input lines.
+    """
+    fd.seek(start)
+    remaining = end - start
+    for line in fd:
+        if remaining <= 0:
+            return
+        remaining -= len(line)
+        yield line
@@ -0,0 +1,49 @@
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_workers(workers):
+    """Return the number of worker processes, `-1` stands for all cores."""
+    return os.cpu_count() if workers < 0 else max(workers, 1)
+
+
+def imap(function, items, workers, *args, initializer=None, initargs=()):
+    """
+    Apply a function to items, optionally on a pool of worker processes.
+
+    Results are yielded in the input order and at most `2 * workers` items are
+    in flight at any time, so memory does not depend on the number of items.
+
+    Args:
+        function (callable): Module level function, called as
+            `function(item, *args)`.
+        items (iterable): Items, e.g. chunks of the input data.
+        workers (int): Number of worker processes, `-1` to use all cores.
+        *args: Additional arguments for the function.
+        initializer (callable): Module level function called once in every
+            worker process (or in this process without workers) before the
+            items are processed, e.g. to load a model.
+        initargs (tuple): Arguments for the initializer.
+
+    Yields:
+        Results of the function.
+    """
+    workers = get_workers(workers)
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield function(item, *args)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,40 +1,252 @@
+import hashlib
+import itertools
 import os
 import random
-import re
 import sys
-import xml.etree.ElementTree
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import yaml
 
+from incremental import (
+    complete_size,
+    input_position,
+    load_state,
+    read_lines,
+    resume_offset,
+    save_state,
+)
+from parallel import imap
+from rows import parse_row
 
-def process_posts(input_lines, fd_out_train, fd_out_test, target_tag, split):
+# Columns of the `parquet` output format
+SCHEMA = pa.schema([("id", pa.int64()), ("label", pa.int64()), ("text", pa.string())])
+# The characters `\s` of `re` matches, in the RE2 syntax of the Arrow kernels,
+# where `\s` is only the ASCII whitespace
+WHITESPACE_RUN = (
+    r"[\t-\r\x{1c}-\x{20}\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}"
+    r"\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}]+"
+)
+
+
+def parse_post(line, target_tag):
+    """
+    Parse a single input line.
+
+    Args:
+        line (bytes): Input line with a single `<row .../>` element.
+        target_tag (str): Target tag.
+
+    Returns:
+        tuple: Post id, label, title and body of the post.
+    """
+    attr = parse_row(line)
+
+    pid = attr.get("Id", "")
+    label = 1 if target_tag in attr.get("Tags", "") else 0
+    return pid, label, attr.get("Title", ""), attr.get("Body", "")
+
+
+def normalize_whitespace(texts):
+    """
+    Replace every run of whitespace with a single space and strip the texts.
+
+    The whole batch is processed by Arrow string kernels with the same
+    whitespace characters as `re`, so the result is the same as
+    `re.sub(r"\\s+", " ", text).strip()` for every text.
+
+    Args:
+        texts (list): Texts.
+
+    Returns:
+        pyarrow.StringArray: Normalized texts.
+    """
+    texts = pc.replace_substring_regex(pa.array(texts, type=pa.string()), WHITESPACE_RUN, " ")
+    # Leading and trailing whitespace is a single space now
+    return pc.utf8_trim(texts, " ")
+
+
+def format_posts(posts):
+    """
+    Format parsed posts as a block of output TSV lines, all at once.
+
+    Args:
+        posts (pyarrow.Table): Posts, see `parse_chunk`.
+
+    Returns:
+        str: Tab separated id, label and text lines of the posts.
+    """
+    if not posts.num_rows:
+        return ""
+    lines = pc.binary_join_element_wise(
+        posts["id"], pc.cast(posts["label"], pa.string()), posts["text"], "\t"
+    )
+    return "\n".join(lines.to_pylist()) + "\n"
+
+
+def write_posts(fd_out, posts, output_format="tsv"):
+    """
+    Write parsed posts to an output file.
+
+    Args:
+        fd_out (file or pyarrow.parquet.ParquetWriter): Output file, a
+            `ParquetWriter` with the `SCHEMA` for the `parquet` format.
+        posts (pyarrow.Table): Posts, see `parse_chunk`.
+        output_format (str): `tsv` or `parquet`.
+    """
+    if output_format == "parquet":
+        if posts.num_rows:
+            posts = posts.set_column(0, "id", pc.cast(posts["id"], pa.int64()))
+            fd_out.write_table(posts.cast(SCHEMA))
+        return
+    fd_out.write(format_posts(posts))
+
+
+def hash_split(pid, seed):
+    """
+    Map a post id to a stable pseudo-random number in `[0, 1)`.
+
+    Unlike `random.random()` the value depends only on the post id and the seed,
+    not on the position of the post in the input.
+
+    Args:
+        pid (str): Post id.
+        seed (int): Random seed.
+
+    Returns:
+        float: Number in `[0, 1)`.
+    """
+    digest = hashlib.blake2b(f"{seed}:{pid}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+def parse_chunk(lines, target_tag):
+    """
+    Parse a chunk of input lines.
+
+    Args:
+        lines (list): List of input lines.
+        target_tag (str): Target tag.
+
+    Returns:
+        tuple: Table of the posts that could be parsed, in the input order,
+            with the id (as in the input), label and normalized text columns,
+            and a list with the parsing error of every line, `None` for the
+            parsed ones.
+    """
+    posts = []
+    errors = []
+    for line in lines:
+        try:
+            posts.append(parse_post(line, target_tag))
+            errors.append(None)
+        except Exception as ex:
+            errors.append(ex)
+
+    # Per post interpreter overhead dominates on short posts, the text
+    # normalization is batched for the whole chunk
+    pids, labels, titles, bodies = zip(*posts) if posts else ((), (), (), ())
+    text = pc.binary_join_element_wise(
+        normalize_whitespace(titles), normalize_whitespace(bodies), " "
+    )
+    table = pa.table(
+        {
+            "id": pa.array(pids, type=pa.string()),
+            "label": pa.array(labels, type=pa.int64()),
+            "text": text,
+        }
+    )
+    return table, errors
+
+
+def iter_chunks(input_lines, chunk_size):
+    """Lazily split the input lines into lists of at most `chunk_size` lines."""
+    input_lines = iter(input_lines)
+    while True:
+        chunk = list(itertools.islice(input_lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_output(path, output_format="tsv", append=False):
+    """
+    Open an output file of the prepared data set.
+
+    Args:
+        path (str): Output file name.
+        output_format (str): `tsv` or `parquet`.
+        append (bool): Whether to append to an existing TSV file.
+
+    Returns:
+        file or pyarrow.parquet.ParquetWriter: Output file for `write_posts`.
+    """
+    if output_format == "parquet":
+        return pq.ParquetWriter(path, SCHEMA)
+    return open(path, "a" if append else "w", encoding="utf-8")
+
+
+def process_posts(
+    input_lines,
+    fd_out_train,
+    fd_out_test,
+    target_tag,
+    split,
+    seed=None,
+    split_mode="random",
+    workers=1,
+    chunk_size=10000,
+    output_format="tsv",
+):
     """
     Process the input lines and write the output to the output files.
 
+    With the `random` split mode the train/test assignment is drawn in the
+    input order in this process, so the output does not depend on the number of
+    workers. With the `hash` split mode the assignment of every post depends
+    only on its id and the seed, so it does not depend on the input order
+    either.
+
     Args:
-        input_lines (list): List of input lines.
-        fd_out_train (file): Output file for the training data set.
+        input_lines (iterable): Input lines, e.g. a file open in binary mode.
+        fd_out_train (file): Output file for the training data set, see
+            `open_output`.
         fd_out_test (file): Output file for the test data set.
         target_tag (str): Target tag.
         split (float): Test data set split ratio.
+        seed (int): Random seed, used by the `hash` split mode.
+        split_mode (str): `random` or `hash`.
+        workers (int): Number of parsing processes, `-1` to use all cores.
+        chunk_size (int): Number of lines sent to a worker at once.
+        output_format (str): `tsv` or `parquet`, see `write_posts`.
     """
-    num = 1
-    for line in input_lines:
-        try:
-            fd_out = fd_out_train if random.random() > split else fd_out_test
-            attr = xml.etree.ElementTree.fromstring(line).attrib
+    if split_mode not in ("random", "hash"):
+        raise ValueError(f"Unsupported split mode: {split_mode}")
 
-            pid = attr.get("Id", "")
-            label = 1 if target_tag in attr.get("Tags", "") else 0
-            title = re.sub(r"\s+", " ", attr.get("Title", "")).strip()
-            body = re.sub(r"\s+", " ", attr.get("Body", "")).strip()
-            text = title + " " + body
+    num = 1
+    chunks = iter_chunks(input_lines, chunk_size)
+    for posts, errors in imap(parse_chunk, chunks, workers, target_tag):
+        pids = iter(posts["id"].to_pylist())
+        in_train = []
+        for error in errors:
+            # Broken lines consume a random number too, as they always did
+            value = random.random() if split_mode == "random" else None
+            if error is not None:
+                sys.stderr.write(f"Skipping the broken line {num}: {error}\n")
+                continue
+            pid = next(pids)
+            if value is None:
+                value = hash_split(pid, seed)
 
-            fd_out.write("{}\t{}\t{}\n".format(pid, label, text))
+            in_train.append(value > split)
 
             num += 1
-        except Exception as ex:
-            sys.stderr.write(f"Skipping the broken line {num}: {ex}\n")
+
+        # Every chunk is written to each output at once
+        in_train = pa.array(in_train, type=pa.bool_())
+        write_posts(fd_out_train, posts.filter(in_train), output_format)
+        write_posts(fd_out_test, posts.filter(pc.invert(in_train)), output_format)
 
 
 def main():
@@ -50,28 +262,72 @@ def main():
     random.seed(params["seed"])
 
     input = sys.argv[1]
-    output_train = os.path.join("data", "prepared", "train.tsv")
-    output_test = os.path.join("data", "prepared", "test.tsv")
+    # The `parquet` format saves typed columns that the featurization stage
+    # reads without parsing text
+    output_format = params["format"]
+    if output_format not in ("tsv", "parquet"):
+        raise ValueError(f"Unsupported prepared data format: {output_format}")
+    if output_format == "parquet" and params["incremental"]:
+        raise ValueError("The incremental mode needs the tsv format")
+    output_train = os.path.join("data", "prepared", f"train.{output_format}")
+    output_test = os.path.join("data", "prepared", f"test.{output_format}")
+    # In the incremental mode the output directory has to be persisted between
+    # runs (`persist: true` in dvc.yaml, as generate.sh declares it), lines
+    # appended to the input since the last run are then appended to the outputs.
+    state_file = os.path.join("data", "prepared", "state.json")
 
     os.makedirs(os.path.join("data", "prepared"), exist_ok=True)
+    # The featurization stage reads whichever format it finds
+    for name in ("train", "test"):
+        for other_format in {"tsv", "parquet"} - {output_format}:
+            path = os.path.join("data", "prepared", f"{name}.{other_format}")
+            if os.path.exists(path):
+                os.remove(path)
 
-    input_lines = []
-    with open(input) as fd_in:
-        input_lines = fd_in.readlines()
+    incremental = params["incremental"]
+    split_params = {key: params[key] for key in ("split", "seed", "split_mode")}
+    state = load_state(state_file) if incremental else None
+    if incremental and not state:
+        sys.stderr.write("No state of a previous incremental run, preparing all\n")
+    if state and state["params"] != split_params:
+        state = None
 
-    fd_out_train = open(output_train, "w", encoding="utf-8")
-    fd_out_test = open(output_test, "w", encoding="utf-8")
+    # The input is streamed line by line, it is never loaded into memory as a whole
+    with open(input, "rb") as fd_in:
+        start = resume_offset(fd_in, state["input"]) if state else 0
+        if start:
+            version, internal, gauss = state["random"]
+            random.setstate((version, tuple(internal), gauss))
+            sys.stderr.write(f"Resuming from the byte {start} of {input}\n")
+        # A trailing incomplete line might still be being appended to the input
+        end = complete_size(fd_in) if incremental else os.fstat(fd_in.fileno()).st_size
 
-    process_posts(
-        input_lines=input_lines,
-        fd_out_train=fd_out_train,
-        fd_out_test=fd_out_test,
-        target_tag="<r>",
-        split=split,
-    )
+        append = bool(start)
+        fd_out_train = open_output(output_train, output_format, append)
+        fd_out_test = open_output(output_test, output_format, append)
+        with fd_out_train, fd_out_test:
+            process_posts(
+                input_lines=read_lines(fd_in, start, end),
+                fd_out_train=fd_out_train,
+                fd_out_test=fd_out_test,
+                target_tag="<r>",
+                split=split,
+                seed=params["seed"],
+                split_mode=params["split_mode"],
+                workers=params["workers"],
+                chunk_size=params["chunk_size"],
+                output_format=output_format,
+            )
 
-    fd_out_train.close()
-    fd_out_test.close()
+        if incremental:
+            state = {
+                "params": split_params,
+                "input": input_position(fd_in, end),
+                "random": random.getstate(),
+            }
+            save_state(state_file, state)
+    if not incremental and os.path.exists(state_file):
+        os.remove(state_file)
 
 
 if __name__ == "__main__":
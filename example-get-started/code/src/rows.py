@@ -0,0 +1,90 @@
+import re
+
+# Every line of a Stack Exchange dump is a single `<row .../>` element with
+# double quoted attributes, separated by single spaces. A `"` inside a value is
+# always escaped, so ` Name="` can only be found where an attribute starts.
+ROW_START = b"<row "
+ROW_END = b"/>"
+ENTITY = re.compile(r"&(?:#x([0-9a-fA-F]+)|#([0-9]+)|([A-Za-z]+));|&")
+# Any entity other than the predefined named ones
+OTHER_ENTITY = re.compile(r"&(?!(?:lt|gt|quot|apos|amp);)")
+# Literal whitespace in attribute values is normalized to spaces
+WHITESPACE = bytes.maketrans(b"\t\n\r", b"   ")
+
+ENTITIES = {"lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}
+
+
+def _replace_entity(match):
+    hex_code, code, name = match.groups()
+    if hex_code is not None:
+        return chr(int(hex_code, 16))
+    if code is not None:
+        return chr(int(code))
+    if name in ENTITIES:
+        return ENTITIES[name]
+    raise ValueError(f"Undefined entity: {match.group()}")
+
+
+def unescape(value):
+    """
+    Decode a raw attribute value the way an XML parser does.
+
+    Literal whitespace characters are normalized to spaces and the predefined
+    and character entities are replaced.
+
+    Args:
+        value (bytes): Raw attribute value between the quotes.
+
+    Returns:
+        str: Attribute value.
+    """
+    if b"\r" in value:
+        value = value.replace(b"\r\n", b"\n")
+    value = value.translate(WHITESPACE).decode("utf-8")
+    if "&" not in value:
+        return value
+    # Line breaks of posts are escaped in the dumps
+    value = value.replace("&#xA;", "\n").replace("&#xD;", "\r")
+    if OTHER_ENTITY.search(value):
+        return ENTITY.sub(_replace_entity, value)
+    # Only the predefined entities, `&amp;` goes last not to unescape twice
+    value = value.replace("&lt;", "<").replace("&gt;", ">")
+    value = value.replace("&quot;", '"').replace("&apos;", "'")
+    return value.replace("&amp;", "&")
+
+
+def parse_row(line, names=("Id", "Tags", "Title", "Body")):
+    """
+    Read a few attributes of a `<row .../>` line without building an element.
+
+    The attributes are found with plain byte searches and only the requested
+    ones are decoded. For the rows of a dump the values are the same
+    `xml.etree.ElementTree.fromstring(line).attrib` gives, but the rest of the
+    line is not checked to be well formed XML.
+
+    Args:
+        line (bytes): Input line with a single `<row .../>` element.
+        names (tuple): Names of the attributes to read.
+
+    Returns:
+        dict: Values of the requested attributes present in the row.
+
+    Raises:
+        ValueError: If the line is not a row or an attribute is malformed.
+    """
+    line = line.strip()
+    if not line.startswith(ROW_START) or not line.endswith(ROW_END):
+        raise ValueError(f"Not a row element: {line[:80]!r}")
+
+    attrib = {}
+    for name in names:
+        start = line.find(b" " + name.encode("ascii") + b'="')
+        if start < 0:
+            continue
+        start += len(name) + 3
+        end = line.find(b'"', start)
+        value = line[start:end]
+        if end < 0 or b"<" in value:
+            raise ValueError(f"Malformed attribute {name}: {line[:80]!r}")
+        attrib[name] = unescape(value)
+    return attrib
@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+
+from featurization import get_df_chunks
+from forest import load_model
+from parallel import imap
+from prepare import iter_chunks, parse_chunk
+from vectorizer import load_vectorizer
+
+# Model and vectorizer of the current process, loaded once by `init_scorer`
+model = None
+vectorizer = None
+
+SCHEMA = pa.schema([("id", pa.int64()), ("probability", pa.float64())])
+
+
+def init_scorer(model_file, vectorizer_path):
+    """
+    Load the model and the fitted vectorizer in the current process.
+
+    Args:
+        model_file (str): Model file or directory name.
+        vectorizer_path (str): Vectorizer directory saved by the featurization stage.
+    """
+    global model, vectorizer
+    model = load_model(model_file)
+    # Processes already score chunks in parallel, one thread per process is enough
+    if hasattr(model, "n_jobs"):
+        model.set_params(n_jobs=1)
+    vectorizer = load_vectorizer(vectorizer_path)
+
+
+def score_chunk(chunk):
+    """
+    Featurize and score a chunk of posts.
+
+    Args:
+        chunk (list or pandas.DataFrame): Lines of a Posts.xml file or a chunk
+            of a prepared data frame.
+
+    Returns:
+        tuple: Post ids, probabilities of the target tag and number of skipped
+            broken lines.
+    """
+    if isinstance(chunk, list):
+        posts, _ = parse_chunk(chunk, "")
+        ids = np.array([int(pid) for pid in posts["id"].to_pylist()], dtype=np.int64)
+        texts = posts["text"].to_pylist()
+        skipped = len(chunk) - posts.num_rows
+    else:
+        ids = chunk.id.to_numpy(dtype=np.int64)
+        texts = chunk.text.fillna("").tolist()
+        skipped = 0
+
+    if not texts:
+        return ids, np.empty(0), skipped
+    x = vectorizer.transform(texts)
+    return ids, model.predict_proba(x)[:, 1], skipped
+
+
+def read_chunks(input, chunk_size):
+    """
+    Lazily read chunks of posts from a Posts.xml file or a prepared data file.
+
+    Args:
+        input (str): Input file name, `.xml`, `.tsv` or `.parquet`.
+        chunk_size (int): Number of posts per chunk.
+
+    Yields:
+        list or pandas.DataFrame: Chunk for `score_chunk`.
+    """
+    if input.endswith(".xml"):
+        with open(input, "rb") as fd:
+            yield from iter_chunks(fd, chunk_size)
+    else:
+        yield from get_df_chunks(input, chunk_size)
+
+
+def main():
+    params = yaml.safe_load(open("params.yaml"))["score"]
+
+    if len(sys.argv) != 5:
+        sys.stderr.write("Arguments error. Usage:\n")
+        sys.stderr.write("\tpython score.py model features input output\n")
+        sys.exit(1)
+
+    model_file = sys.argv[1]
+    vectorizer_path = os.path.join(sys.argv[2], "vectorizer")
+    input = sys.argv[3]
+    output = sys.argv[4]
+
+    start = time.time()
+    rows = skipped = 0
+    # Every chunk becomes a row group, only the chunks in flight are in memory
+    with pq.ParquetWriter(output, SCHEMA) as writer:
+        results = imap(
+            score_chunk,
+            read_chunks(input, params["chunk_size"]),
+            params["workers"],
+            initializer=init_scorer,
+            initargs=(model_file, vectorizer_path),
+        )
+        for ids, probabilities, chunk_skipped in results:
+            table = pa.Table.from_arrays([ids, probabilities], schema=SCHEMA)
+            writer.write_table(table)
+            rows += len(ids)
+            skipped += chunk_skipped
+
+    elapsed = max(time.time() - start, 1e-9)
+    msg = "Scored {} posts in {:.1f}s ({:.0f} rows/s), skipped {} broken lines\n"
+    sys.stderr.write(msg.format(rows, elapsed, rows / elapsed, skipped))
+
+
+if __name__ == "__main__":
+    main()
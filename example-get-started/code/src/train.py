@@ -1,3 +1,4 @@
+import hashlib
 import os
 import pickle
 import sys
@@ -6,33 +7,107 @@ import numpy as np
 import yaml
 from sklearn.ensemble import RandomForestClassifier
 
+from feature_store import load_features
+from forest import save_model
 
-def train(seed, n_est, min_split, matrix):
+
+def data_digest(features):
     """
-    Train a random forest classifier.
+    Compute a digest of the train data set, to detect if a model was trained on it.
+
+    Args:
+        features (feature_store.FeatureSet): Train data set.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    x = features.x
+    for array in (x.data, x.indices, x.indptr, features.labels):
+        digest.update(np.ascontiguousarray(array).data)
+    digest.update(str(x.shape).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_previous_model(model_file, seed, min_split, digest):
+    """
+    Load the previous model to warm start from, if it is compatible.
+
+    The previous model is only reused if it was trained with the same params
+    (other than the number of trees) on the same train data set.
 
     Args:
+        model_file (str): Model file name.
         seed (int): Random seed.
-        n_est (int): Number of trees in the forest.
         min_split (int): Minimum number of samples required to split an internal node.
-        matrix (scipy.sparse.csr_matrix): Input matrix.
+        digest (str): Digest of the train data set, see `data_digest`.
 
     Returns:
-        sklearn.ensemble.RandomForestClassifier: Trained classifier.
+        sklearn.ensemble.RandomForestClassifier: Previous classifier or `None`.
     """
-    labels = np.squeeze(matrix[:, 1].toarray())
-    x = matrix[:, 2:]
+    if not os.path.exists(model_file):
+        sys.stderr.write("No previous model to warm start from, training all trees\n")
+        return None
+    # Only pickled models can be trained further
+    if not os.path.isfile(model_file):
+        return None
+    with open(model_file, "rb") as fd:
+        clf = pickle.load(fd)
+    if (
+        not isinstance(clf, RandomForestClassifier)
+        or clf.random_state != seed
+        or clf.min_samples_split != min_split
+        or getattr(clf, "train_digest_", None) != digest
+    ):
+        return None
+    return clf
 
-    sys.stderr.write("Input matrix size {}\n".format(matrix.shape))
-    sys.stderr.write("X matrix size {}\n".format(x.shape))
-    sys.stderr.write("Y matrix size {}\n".format(labels.shape))
 
-    clf = RandomForestClassifier(
-        n_estimators=n_est, min_samples_split=min_split, n_jobs=2, random_state=seed
-    )
+def train(seed, n_est, min_split, features, n_jobs=2, previous=None):
+    """
+    Train a random forest classifier.
 
-    clf.fit(x, labels)
+    With a previous classifier only the trees it is missing are fitted. Every
+    tree gets its random state from the same sequence, so the result is the
+    same as training all `n_est` trees from scratch.
 
+    Args:
+        seed (int): Random seed.
+        n_est (int): Number of trees in the forest.
+        min_split (int): Minimum number of samples required to split an internal node.
+        features (feature_store.FeatureSet): Train data set.
+        n_jobs (int): Number of parallel jobs, `-1` to use all cores.
+        previous (sklearn.ensemble.RandomForestClassifier): Classifier trained
+            with the same params on the same data set to warm start from.
+
+    Returns:
+        sklearn.ensemble.RandomForestClassifier: Trained classifier.
+    """
+    sys.stderr.write("X matrix size {}\n".format(features.x.shape))
+    sys.stderr.write("Y matrix size {}\n".format(features.labels.shape))
+
+    if previous is None:
+        clf = RandomForestClassifier(
+            n_estimators=n_est,
+            min_samples_split=min_split,
+            n_jobs=n_jobs,
+            random_state=seed,
+        )
+        clf.fit(features.x, features.labels)
+        return clf
+
+    clf = previous
+    n_trained = len(clf.estimators_)
+    sys.stderr.write(f"Warm start from {n_trained} trees\n")
+    if n_est <= n_trained:
+        # The first trees are exactly the ones a smaller forest would have
+        clf.estimators_ = clf.estimators_[:n_est]
+        clf.set_params(n_estimators=n_est, n_jobs=n_jobs)
+        return clf
+
+    clf.set_params(n_estimators=n_est, n_jobs=n_jobs, warm_start=True)
+    clf.fit(features.x, features.labels)
+    clf.set_params(warm_start=False)
     return clf
 
 
@@ -51,14 +126,28 @@ def main():
     min_split = params["min_split"]
 
     # Load the data
-    with open(os.path.join(input, "train.pkl"), "rb") as fd:
-        matrix, _ = pickle.load(fd)
-
-    clf = train(seed=seed, n_est=n_est, min_split=min_split, matrix=matrix)
+    features = load_features(os.path.join(input, "train"))
+    digest = data_digest(features)
+
+    # In the warm start mode the model has to be persisted between runs
+    # (`persist: true` in dvc.yaml, as generate.sh declares it), only the
+    # additional trees are fitted then
+    previous = None
+    if params["warm_start"]:
+        previous = load_previous_model(output, seed, min_split, digest)
+
+    clf = train(
+        seed=seed,
+        n_est=n_est,
+        min_split=min_split,
+        features=features,
+        n_jobs=params["n_jobs"],
+        previous=previous,
+    )
+    clf.train_digest_ = digest
 
     # Save the model
-    with open(output, "wb") as fd:
-        pickle.dump(clf, fd)
+    save_model(output, clf, params["model_format"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sparse
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
+
+# Files of a saved vectorizer: the analyzer settings, the vocabulary (count
+# vectorizer only) and the IDF weights of the train data set.
+CONFIG = "config.json"
+VOCABULARY = "vocabulary.npy"
+IDF = "idf.npy"
+
+
+def make_bag_of_words(vectorizer, max_features, ngrams, vocabulary=None):
+    """
+    Create the term counting vectorizer used by the featurization stage.
+
+    Args:
+        vectorizer (str): `count` or `hashing`.
+        max_features (int): Size of the vocabulary or number of hashed columns.
+        ngrams (int): Maximum n-gram size.
+        vocabulary (list): Fixed vocabulary of the count vectorizer.
+
+    Returns:
+        sklearn.feature_extraction.text.CountVectorizer: Bag of words, or a
+            hashing vectorizer that outputs raw term counts.
+    """
+    if vectorizer == "count":
+        return CountVectorizer(
+            stop_words="english",
+            max_features=max_features,
+            ngram_range=(1, ngrams),
+            vocabulary=vocabulary,
+        )
+    if vectorizer == "hashing":
+        # No vocabulary to fit, every term is hashed into one of `max_features`
+        # columns, the raw counts are weighted with TF-IDF afterwards
+        return HashingVectorizer(
+            stop_words="english",
+            n_features=max_features,
+            ngram_range=(1, ngrams),
+            alternate_sign=False,
+            norm=None,
+        )
+    raise ValueError(f"Unsupported vectorizer: {vectorizer}")
+
+
+def compute_idf(doc_freq, n_docs, smooth_idf=False):
+    """
+    Compute the IDF weights the same way `TfidfTransformer` does.
+
+    Args:
+        doc_freq (numpy.ndarray): Number of train documents containing each term.
+        n_docs (int): Number of train documents.
+        smooth_idf (bool): Whether to smooth the IDF weights.
+
+    Returns:
+        numpy.ndarray: IDF weights.
+    """
+    return np.log((n_docs + smooth_idf) / (doc_freq + smooth_idf)) + 1
+
+
+def apply_idf(counts, idf):
+    """
+    Weight a term count matrix with IDF weights and normalize its rows.
+
+    Args:
+        counts (scipy.sparse.csr_matrix): Term count matrix.
+        idf (numpy.ndarray): IDF weights.
+
+    Returns:
+        scipy.sparse.csr_matrix: TF-IDF matrix.
+    """
+    matrix = sparse.csr_matrix(counts, dtype=np.float64, copy=True)
+    matrix.data *= idf[matrix.indices]
+    return normalize(matrix, norm="l2", copy=False)
+
+
+def save_vectorizer(path, bag_of_words, idf):
+    """
+    Save a fitted vectorizer as its settings, vocabulary and IDF arrays.
+
+    Args:
+        path (str): Output directory.
+        bag_of_words (sklearn.feature_extraction.text.CountVectorizer): Fitted
+            bag of words or a hashing vectorizer.
+        idf (numpy.ndarray): IDF weights.
+    """
+    os.makedirs(path, exist_ok=True)
+    config = {
+        "vectorizer": "hashing",
+        "ngrams": bag_of_words.ngram_range[1],
+        "n_features": len(idf),
+    }
+    if isinstance(bag_of_words, CountVectorizer):
+        config["vectorizer"] = "count"
+        vocabulary = bag_of_words.get_feature_names_out()
+        np.save(os.path.join(path, VOCABULARY), vocabulary.astype(str))
+
+    np.save(os.path.join(path, IDF), np.asarray(idf, dtype=np.float64))
+    with open(os.path.join(path, CONFIG), "w", encoding="utf-8") as fd:
+        json.dump(config, fd)
+
+
+class TextVectorizer:
+    """
+    Fitted featurization that turns raw post texts into TF-IDF feature rows.
+
+    Load it once with `load_vectorizer` and call `transform` on batches of
+    texts, e.g. to score new posts without rerunning the featurization stage.
+    """
+
+    def __init__(self, bag_of_words, idf):
+        self.bag_of_words = bag_of_words
+        self.idf = idf
+        # Validate the vocabulary now, not on the first batch
+        self.bag_of_words.transform([""])
+
+    def transform(self, texts):
+        """
+        Featurize a batch of texts.
+
+        Args:
+            texts (list): Post texts, title and body.
+
+        Returns:
+            scipy.sparse.csr_matrix: Feature matrix with float32 values, ready
+                for the random forest.
+        """
+        counts = self.bag_of_words.transform([text.lower() for text in texts])
+        return apply_idf(counts, self.idf).astype(np.float32)
+
+
+def load_vectorizer(path):
+    """
+    Load a vectorizer saved by `save_vectorizer`.
+
+    Args:
+        path (str): Input directory, e.g. `data/features/vectorizer`.
+
+    Returns:
+        TextVectorizer: Fitted vectorizer.
+    """
+    with open(os.path.join(path, CONFIG), encoding="utf-8") as fd:
+        config = json.load(fd)
+
+    vocabulary = None
+    if config["vectorizer"] == "count":
+        vocabulary = np.load(os.path.join(path, VOCABULARY)).tolist()
+    bag_of_words = make_bag_of_words(
+        config["vectorizer"], config["n_features"], config["ngrams"], vocabulary
+    )
+    return TextVectorizer(bag_of_words, np.load(os.path.join(path, IDF)))
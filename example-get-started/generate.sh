@@ -263,11 +263,16 @@ tick
 git commit -m "${COMMIT_PREFIX}Add source code files to repo"
 create_tag "5-source-code${GIT_TAG_SUFFIX}" "Source code added."
 
+# The prepared data sets must not depend on how the input is chunked
+python $HERE/check_prepare.py data/data.xml
+
 if [ $OPT_NON_DVC == 'false' ]; then
   dvc stage add -n prepare \
-    -p prepare.seed,prepare.split \
+    -p prepare.seed,prepare.split,prepare.split_mode,prepare.format \
+    -p prepare.incremental \
     -d src/prepare.py -d data/data.xml \
-    -o data/prepared \
+    -d src/incremental.py -d src/parallel.py -d src/rows.py \
+    --outs-persist data/prepared \
     python src/prepare.py data/data.xml
   dvc repro
   git add data/.gitignore dvc.yaml dvc.lock
@@ -277,15 +282,19 @@ if [ $OPT_NON_DVC == 'false' ]; then
   dvc push
 
   dvc stage add -n featurize \
-    -p featurize.max_features,featurize.ngrams \
+    -p featurize.max_features,featurize.ngrams,featurize.vectorizer,featurize.format \
+    -p featurize.incremental \
     -d src/featurization.py -d data/prepared \
-    -o data/features \
+    -d src/incremental.py -d src/feature_store.py -d src/parallel.py -d src/vectorizer.py \
+    --outs-persist data/features \
     python src/featurization.py \
     data/prepared data/features
   dvc stage add -n train \
-    -p train.seed,train.n_est,train.min_split \
+    -p train.seed,train.n_est,train.min_split,train.model_format \
+    -p train.warm_start \
     -d src/train.py -d data/features \
-    -o model.pkl \
+    -d src/feature_store.py -d src/forest.py \
+    --outs-persist model.pkl \
     python src/train.py data/features model.pkl
   dvc repro
 
@@ -312,11 +321,17 @@ EOF
 
   if [ $OPT_DVC_TRACKED_METRICS == "true" ]; then
     dvc stage add -n evaluate \
+      -p evaluate.seed,evaluate.train_sample,evaluate.plot_points \
+      -p evaluate.importance_format \
       -d src/evaluate.py -d model.pkl -d data/features -o eval \
+      -d src/feature_store.py -d src/forest.py -d src/curves.py \
       python src/evaluate.py model.pkl data/features
   else
     dvc stage add -n evaluate \
+      -p evaluate.seed,evaluate.train_sample,evaluate.plot_points \
+      -p evaluate.importance_format \
       -d src/evaluate.py -d model.pkl -d data/features -O eval \
+      -d src/feature_store.py -d src/forest.py -d src/curves.py \
       python src/evaluate.py model.pkl data/features
   fi
 
@@ -340,8 +355,16 @@ plots:
     x: recall
     y:
       eval/plots/sklearn/prc/train.json: precision
-      eval/plots/sklearn/prc/test.json: precision
-- eval/plots/images/importance.png" >> dvc.yaml
+      eval/plots/sklearn/prc/test.json: precision" >> dvc.yaml
+  # Only the plot of the configured evaluate.importance_format exists
+  if grep -q "importance_format: png" params.yaml; then
+    echo "- eval/plots/images/importance.png" >> dvc.yaml
+  else
+    echo "- eval/plots/custom:
+    template: bar_horizontal_sorted
+    x: importance
+    y: feature" >> dvc.yaml
+  fi
 
   dvc repro
   if [ $OPT_DVC_TRACKED_METRICS == "true" ]; then
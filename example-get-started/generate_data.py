@@ -1,34 +1,28 @@
-import io
+import argparse
 import os
 import random
 import sys
-import xml.etree.ElementTree
 
 # This file is not part of the project but is used to generate a slice of
 # data from the full SO dump https://archive.org/details/stackexchange
 
-
-if len(sys.argv) != 3:
-    sys.stderr.write("Arguments error. Usage:\n")
-    sys.stderr.write("\tpython analyze.py data-file output-file\n")
-    sys.exit(1)
-
-
-target = 40000
-split = 0.3
+# Reuse the row reader of the prepare stage
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code", "src")
+sys.path.insert(0, SRC_DIR)
+from rows import parse_row  # noqa: E402
 
 
 def lines_matched_test(fd, test):
     for line in fd:
         try:
-            attr = xml.etree.ElementTree.fromstring(line).attrib
+            attr = parse_row(line, names=("Tags",))
             if test(attr.get("Tags", "")):
                 yield line
         except Exception as ex:
             sys.stderr.write(f"Skipping the broken line: {ex}\n")
 
 
-def process_posts(fd_in, fd_not, fd_out):
+def process_posts(fd_in, fd_not, fd_out, target, split):
     count = 0
     in_lines = lines_matched_test(fd_in, lambda x: "<r>" in x)
     not_lines = lines_matched_test(fd_not, lambda x: "<r>" not in x)
@@ -38,7 +32,116 @@ def process_posts(fd_in, fd_not, fd_out):
         count += 1
 
 
-with io.open(sys.argv[1], encoding="utf8") as fd_in:
-    with io.open(sys.argv[1], encoding="utf8") as fd_not:
-        with io.open(sys.argv[2], "w", encoding="utf8") as fd_out:
-            process_posts(fd_in, fd_not, fd_out)
+def get_tags(line):
+    """
+    Find the raw Tags attribute of a row without parsing the XML.
+
+    Args:
+        line (bytes): Input line.
+
+    Returns:
+        bytes: Escaped attribute value, empty if the row has no tags, or `None`
+            if the line is not a row.
+    """
+    if not line.lstrip().startswith(b"<row "):
+        return None
+    start = line.find(b' Tags="')
+    if start < 0:
+        return b""
+    start += len(b' Tags="')
+    end = line.find(b'"', start)
+    return line[start:end]
+
+
+def is_valid(line):
+    try:
+        parse_row(line)
+        return True
+    except Exception as ex:
+        sys.stderr.write(f"Skipping the broken line: {ex}\n")
+        return False
+
+
+def sample_posts(fd_in, fd_out, target, split):
+    """
+    Sample posts uniformly with and without the `r` tag in a single pass.
+
+    Every line is classified with a byte-level scan of its Tags attribute and
+    offered to one of two reservoirs, sized to hit the target ratio. Only the
+    lines that enter a reservoir are parsed, to skip the broken ones.
+
+    Args:
+        fd_in (file): Posts dump opened in binary mode.
+        fd_out (file): Output file opened in binary mode.
+        target (int): Number of posts to sample.
+        split (float): Fraction of the posts with the `r` tag.
+    """
+    n_in = round(target * split)
+    sizes = {True: n_in, False: target - n_in}
+    reservoirs = {True: [], False: []}
+    seen = {True: 0, False: 0}
+    for line in fd_in:
+        tags = get_tags(line)
+        if tags is None:
+            continue
+        matched = b"&lt;r&gt;" in tags
+        reservoir = reservoirs[matched]
+        size = sizes[matched]
+        # Algorithm R, position `i` replaces a sampled line with probability
+        # `size / (i + 1)`
+        i = seen[matched]
+        slot = i if i < size else random.randrange(i + 1)
+        if slot >= size or not is_valid(line):
+            seen[matched] += slot >= size
+            continue
+        seen[matched] += 1
+        if slot == len(reservoir):
+            reservoir.append(line)
+        else:
+            reservoir[slot] = line
+
+    for matched, reservoir in reservoirs.items():
+        if len(reservoir) < sizes[matched]:
+            sys.stderr.write(
+                f"Only {len(reservoir)} posts {'with' if matched else 'without'} "
+                f"the r tag, {sizes[matched]} requested\n"
+            )
+
+    lines = reservoirs[True] + reservoirs[False]
+    random.shuffle(lines)
+    fd_out.writelines(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a slice of posts from the full SO dump."
+    )
+    parser.add_argument("data_file", help="Posts.xml of the dump")
+    parser.add_argument("output_file", help="Output XML file")
+    parser.add_argument("--target", type=int, default=40000, help="Number of posts to generate")
+    parser.add_argument(
+        "--split", type=float, default=0.3, help="Fraction of posts with the r tag"
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Sample uniformly from the whole dump, reading it once",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.single_pass:
+        with open(args.data_file, "rb") as fd_in:
+            with open(args.output_file, "wb") as fd_out:
+                sample_posts(fd_in, fd_out, args.target, args.split)
+        return
+
+    with open(args.data_file, "rb") as fd_in:
+        with open(args.data_file, "rb") as fd_not:
+            with open(args.output_file, "wb") as fd_out:
+                process_posts(fd_in, fd_not, fd_out, args.target, args.split)
+
+
+if __name__ == "__main__":
+    main()